@@ -0,0 +1,81 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of account name resolution as account and attachment counts grow.
+
+Compares the previous linear scan of the account list for every attachment against
+the account index used by iter_transit_gateway_attachments, which is built once per
+invocation and shared by every region.
+
+Usage:
+    python benchmarks/account_index_benchmark.py [--accounts 100 1000 5000] [--attachments 100 1000 5000]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+
+def linear_scan(account_list: list, owner_ids: list):
+    names = []
+    for owner_id in owner_ids:
+        account_name = "MISSING"
+        for account in [x for x in account_list if x['id'] == owner_id]:
+            account_name = account['name']
+        names.append(account_name)
+    return names
+
+
+def indexed(account_list: list, owner_ids: list, build_account_index):
+    account_index = build_account_index(account_list)
+    return [account_index.get(owner_id, "MISSING") for owner_id in owner_ids]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--accounts', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--attachments', type=int, nargs='+', default=[100, 1000, 5000])
+    args = parser.parse_args()
+
+    os.environ.setdefault('REGION_LIST', 'eu-west-1')
+    os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', '1')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    from tgw_tagger_attachment_query import build_account_index
+
+    print(f"{'accounts':>9} {'attachments':>12} {'linear scan':>12} {'index':>10} {'speedup':>9}")
+    for account_count in args.accounts:
+        account_list = [{"id": f"{i:012d}", "name": f"account-{i}"} for i in range(account_count)]
+        for attachment_count in args.attachments:
+            # Spread attachment owners across the whole account list, including unknown owners
+            owner_ids = [f"{(i * 7919) % (account_count + 10):012d}" for i in range(attachment_count)]
+
+            start = time.perf_counter()
+            expected = linear_scan(account_list, owner_ids)
+            linear_elapsed = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = indexed(account_list, owner_ids, build_account_index)
+            index_elapsed = time.perf_counter() - start
+
+            assert result == expected
+            print(f"{account_count:>9} {attachment_count:>12} {linear_elapsed:>11.4f}s {index_elapsed:>9.4f}s {linear_elapsed / index_elapsed:>8.0f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Micro-benchmark comparing a new EC2 client per call against the cached per-region client.
+
+Both variants call search_transit_gateway_routes against a local stub endpoint, so the
+difference between them is the per-call client construction and connection setup cost.
+
+Usage:
+    python benchmarks/client_pool_benchmark.py [--calls 200]
+"""
+
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SEARCH_ROUTES_RESPONSE = b"""<?xml version="1.0" encoding="UTF-8"?>
+<SearchTransitGatewayRoutesResponse xmlns="http://ec2.amazonaws.com/doc/2016-11-15/">
+    <requestId>00000000-0000-0000-0000-000000000000</requestId>
+    <routeSet>
+        <item>
+            <destinationCidrBlock>10.0.0.0/16</destinationCidrBlock>
+            <transitGatewayAttachments>
+                <item>
+                    <resourceId>vpc-00000000000000000</resourceId>
+                    <transitGatewayAttachmentId>tgw-attach-00000000000000000</transitGatewayAttachmentId>
+                    <resourceType>vpc</resourceType>
+                </item>
+            </transitGatewayAttachments>
+            <type>propagated</type>
+            <state>active</state>
+        </item>
+    </routeSet>
+    <additionalRoutesAvailable>false</additionalRoutesAvailable>
+</SearchTransitGatewayRoutesResponse>"""
+
+
+class StubEC2Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        StubEC2Handler.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/xml')
+        self.send_header('Content-Length', str(len(SEARCH_ROUTES_RESPONSE)))
+        self.end_headers()
+        self.wfile.write(SEARCH_ROUTES_RESPONSE)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def search_routes(client):
+    client.search_transit_gateway_routes(
+        TransitGatewayRouteTableId='tgw-rtb-00000000000000000',
+        Filters=[{'Name': 'attachment.transit-gateway-attachment-id', 'Values': ['tgw-attach-00000000000000000']}]
+    )
+
+
+def run(label: str, get_client, calls: int):
+    StubEC2Handler.connections = 0
+    start = time.perf_counter()
+    for _ in range(calls):
+        search_routes(get_client('eu-west-1'))
+    elapsed = time.perf_counter() - start
+    print(f"{label:<24} {calls:>6} calls  {elapsed:8.3f}s  {elapsed / calls * 1000:8.3f} ms/call  {StubEC2Handler.connections:>5} connections")
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=200, help="number of search_transit_gateway_routes calls per variant")
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubEC2Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ['AWS_ENDPOINT_URL_EC2'] = f"http://127.0.0.1:{server.server_address[1]}"
+    os.environ['AWS_ACCESS_KEY_ID'] = 'benchmark'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'benchmark'
+    os.environ.setdefault('POWERTOOLS_TRACE_DISABLED', '1')
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+    import boto3 # type: ignore
+    import tgw_tagger_rtb_query
+
+    uncached = run("client per call", lambda region: boto3.client('ec2', region_name=region), args.calls)
+    cached = run("cached regional client", tgw_tagger_rtb_query.get_ec2_client, args.calls)
+    print(f"per-call overhead removed: {(uncached - cached) / args.calls * 1000:.3f} ms ({uncached / cached:.1f}x faster)")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,115 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of the Lambda module init time, the work done once per cold start.
+
+Every module is imported in a fresh interpreter several times, with the environment the main stack
+gives the Lambdas, and the median import time is reported together with the slowest imports
+seen by "python -X importtime". With --budget-ms the benchmark fails when a module is slower than
+the budget, so it can guard against init time regressions.
+
+Usage:
+    python benchmarks/import_time_benchmark.py [--repeat 5] [--budget-ms 1500] [--top 5]
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = [
+    "tgw_tagger_organizations_account_query",
+    "tgw_tagger_attachment_query",
+    "tgw_tagger_rtb_query",
+    "tgw_tagger_attachment_tagger",
+]
+
+LAMBDA_ENVIRONMENT = {
+    'AWS_ACCESS_KEY_ID': 'benchmark',
+    'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    'AWS_DEFAULT_REGION': 'eu-west-1',
+    'AWS_REGION': 'eu-west-1',
+    'AWS_LAMBDA_FUNCTION_NAME': 'tgw-tagger-import-benchmark',
+    'REGION_LIST': 'eu-west-1,us-east-1',
+    'TGW_LIST': '',
+    'ORGANIZATIONS_ROLE_ARN': 'arn:aws:iam::111111111111:role/tgw-attachment-tagger-organization-query-role',
+    'ACCOUNT_CACHE_LOCATION': 's3://tgw-tagger-state/account-cache',
+    'ACCOUNT_CACHE_TTL_SECONDS': '3600',
+    'PAYLOAD_LOCATION': 's3://tgw-tagger-state/payloads',
+}
+
+TIMED_IMPORT = "import time; start = time.perf_counter(); import {module}; print((time.perf_counter() - start) * 1000)"
+
+
+def measure(module: str, src_dir: str, env: dict):
+    result = subprocess.run(
+        [sys.executable, "-c", TIMED_IMPORT.format(module=module)],
+        cwd=src_dir, env=env, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def slowest_imports(module: str, src_dir: str, env: dict, top: int):
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=src_dir, env=env, capture_output=True, text=True, check=True
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        imports.append((int(self_us), name.strip()))
+    return sorted(imports, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=5, help="fresh interpreters per module")
+    parser.add_argument('--budget-ms', type=float, help="fail when the median import time of a module exceeds this")
+    parser.add_argument('--top', type=int, default=5, help="number of slowest imports to list per module, 0 to skip")
+    args = parser.parse_args()
+
+    src_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+    env = {k: v for k, v in os.environ.items() if not k.startswith(('AWS_', 'POWERTOOLS_'))}
+    env.update(LAMBDA_ENVIRONMENT)
+    env['PYTHONDONTWRITEBYTECODE'] = '1'
+
+    # Warm the bytecode and file system caches, a Lambda cold start also loads precompiled dependencies
+    for module in MODULES:
+        measure(module, src_dir, env)
+
+    over_budget = []
+    print(f"{'module':<42} {'median ms':>10} {'min ms':>8} {'max ms':>8}")
+    for module in MODULES:
+        samples = [measure(module, src_dir, env) for _ in range(args.repeat)]
+        median = statistics.median(samples)
+        print(f"{module:<42} {median:>10.1f} {min(samples):>8.1f} {max(samples):>8.1f}")
+        if args.top:
+            for self_us, name in slowest_imports(module, src_dir, env, args.top):
+                print(f"    {self_us / 1000:>8.1f} ms  {name}")
+        if args.budget_ms and median > args.budget_ms:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"Over the {args.budget_ms:.0f} ms budget: {', '.join(over_budget)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
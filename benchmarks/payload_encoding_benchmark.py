@@ -0,0 +1,124 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Benchmark of the region payload passed between the Lambdas, as a list of dictionaries ("json")
+and in the columnar encoding.
+
+For a synthetic region the payload written by each stage (attachment query, RTB query, tagger)
+is encoded and decoded with the functions of the Lambda modules, reporting the compact JSON
+size, the gzip size used for offloaded payloads, encode and decode times and the Python memory
+held by the decoded attachments.
+
+Usage:
+    python benchmarks/payload_encoding_benchmark.py [--attachments 2000] [--accounts 50] [--tagged-fraction 0.2]
+"""
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+STAGES = ["attachment-query", "rtb-query", "tagger"]
+
+
+def stage_attachments(region: dict, account_names: dict):
+    """
+    Returns the attachments of a region as passed on by each stage
+    """
+    queried = []
+    for x in region["attachments"]:
+        tags = {tag["Key"]: tag["Value"] for tag in x["Tags"]}
+        queried.append({
+            "tgwId": x["TransitGatewayId"],
+            "attachmentId": x["TransitGatewayAttachmentId"],
+            "accountId": x["ResourceOwnerId"],
+            "accountName": account_names[x["ResourceOwnerId"]],
+            "nametag": tags.get("Name", "MISSING"),
+        })
+    cidrs = {
+        route["TransitGatewayAttachments"][0]["TransitGatewayAttachmentId"]: route["DestinationCidrBlock"]
+        for routes in region["routes"].values() for route in routes
+    }
+    resolved = [dict(x, cidr=cidrs[x["attachmentId"]] if x["nametag"] == "MISSING" else "NOT_LOOKED_UP") for x in queried]
+    tagged = [dict(x, tagCreated=x["nametag"] == "MISSING") for x in resolved]
+    return dict(zip(STAGES, (queried, resolved, tagged)))
+
+
+def timed(function, argument, repeat: int):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        result = function(argument)
+    return result, (time.perf_counter() - start) * 1000 / repeat
+
+
+def decoded_memory(decode, body: str):
+    tracemalloc.start()
+    attachments = decode(json.loads(body))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del attachments
+    return memory
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--attachments', type=int, default=2000, help="attachments in the region")
+    parser.add_argument('--tgws', type=int, default=2)
+    parser.add_argument('--accounts', type=int, default=50)
+    parser.add_argument('--tagged-fraction', type=float, default=0.2, help="fraction of attachments which already have a Name tag")
+    parser.add_argument('--repeat', type=int, default=20, help="encode and decode repetitions averaged in the timings")
+    args = parser.parse_args()
+
+    benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(benchmark_dir, '..', 'src'))
+    sys.path.insert(0, benchmark_dir)
+    from simulated_backend import generate_topology
+
+    os.environ.update({
+        'AWS_DEFAULT_REGION': 'sim-region-1',
+        'POWERTOOLS_TRACE_DISABLED': '1',
+        'REGION_LIST': 'sim-region-1',
+    })
+    import tgw_tagger_attachment_query
+    import tgw_tagger_attachment_tagger
+
+    topology = generate_topology(regions=1, tgws=args.tgws, attachments=args.attachments, accounts=args.accounts,
+                                 tagged_fraction=args.tagged_fraction)
+    account_names = {x["Id"]: x["Name"] for x in topology["accounts"]}
+    stages = stage_attachments(topology["regions"]["sim-region-1"], account_names)
+
+    encodings = {
+        "json": (lambda attachments: attachments, lambda payload: payload),
+        "columnar": (tgw_tagger_attachment_query.encode_attachments, tgw_tagger_attachment_tagger.decode_attachments),
+    }
+    print(f"{args.attachments} attachments, {args.tgws} TGWs, {args.accounts} accounts, {args.tagged_fraction:.0%} already tagged")
+    print(f"{'stage':<17} {'encoding':<9} {'JSON KiB':>9} {'gzip KiB':>9} {'encode ms':>10} {'decode ms':>10} {'decoded KiB':>12}")
+    for stage, attachments in stages.items():
+        for name, (encode, decode) in encodings.items():
+            payload, encode_ms = timed(lambda x: json.dumps(encode(x), separators=(',', ':')), attachments, args.repeat)
+            decoded, decode_ms = timed(lambda x: decode(json.loads(x)), payload, args.repeat)
+            if decoded != attachments:
+                raise RuntimeError(f"{name} encoding of the {stage} payload does not round trip")
+            print(f"{stage:<17} {name:<9} {len(payload) / 1024:>9.1f} {len(gzip.compress(payload.encode('utf-8'))) / 1024:>9.1f} "
+                  f"{encode_ms:>10.2f} {decode_ms:>10.2f} {decoded_memory(decode, payload) / 1024:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
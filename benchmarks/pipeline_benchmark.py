@@ -0,0 +1,215 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+End to end benchmark of the four Lambda handlers against a simulated EC2/Organizations backend.
+
+The handlers run in the same order as the Step Function: account query, attachment query,
+then the RTB query and tagger for every Map item. For each stage the benchmark reports
+wall time, API calls by operation, throttled calls and peak Python memory.
+With --all-in-one the pipeline runs through src/tgw_tagger_runner.py instead, with regions in parallel.
+
+Examples:
+    python benchmarks/pipeline_benchmark.py --regions 4 --attachments 800 --route-tables 40
+    python benchmarks/pipeline_benchmark.py --latency-ms 20 --rate-limit 50 --env RTB_QUERY_MODE=search
+    python benchmarks/pipeline_benchmark.py --runs 2 --state-dir /tmp/tgw-tagger-state --env DELTA_MODE=true
+    python benchmarks/pipeline_benchmark.py --latency-ms 20 --all-in-one
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+from collections import Counter
+
+STAGES = ["account-query", "attachment-query", "rtb-query", "tagger"]
+
+
+class LambdaContext:
+    function_name = "tgw-tagger-benchmark"
+    memory_limit_in_mb = 512
+    invoked_function_arn = "arn:aws:lambda:sim-region-1:111111111111:function:tgw-tagger-benchmark"
+
+    def __init__(self):
+        self.aws_request_id = str(uuid.uuid4())
+
+
+class StageStats:
+    def __init__(self):
+        self.invocations = 0
+        self.failures = 0
+        self.elapsed = 0.0
+        self.peak_memory = 0
+        self.calls = Counter()
+        self.throttles = Counter()
+
+
+def run_stage(stats: StageStats, backend, measure_memory: bool, handler, event):
+    calls_before = backend.calls.copy()
+    throttles_before = backend.throttles.copy()
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        return handler(event, LambdaContext())
+    except RuntimeError:
+        stats.failures += 1
+        return None
+    finally:
+        stats.elapsed += time.perf_counter() - start
+        if measure_memory:
+            stats.peak_memory = max(stats.peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        stats.invocations += 1
+        stats.calls.update(backend.calls - calls_before)
+        stats.throttles.update(backend.throttles - throttles_before)
+
+
+def run_pipeline(modules: dict, backend, measure_memory: bool):
+    stats = {stage: StageStats() for stage in STAGES}
+    accounts = run_stage(stats["account-query"], backend, measure_memory, modules["account-query"].lambda_handler, {})
+    if accounts is None:
+        return stats
+    attachments = run_stage(stats["attachment-query"], backend, measure_memory, modules["attachment-query"].lambda_handler, accounts)
+    if attachments is None:
+        return stats
+    for map_item in attachments["MapInput"]:
+        map_item = run_stage(stats["rtb-query"], backend, measure_memory, modules["rtb-query"].lambda_handler, map_item)
+        if map_item is not None:
+            run_stage(stats["tagger"], backend, measure_memory, modules["tagger"].lambda_handler, map_item)
+    return stats
+
+
+def run_all_in_one(runner, backend, measure_memory: bool):
+    calls_before = backend.calls.copy()
+    throttles_before = backend.throttles.copy()
+    if measure_memory:
+        tracemalloc.start()
+    summary, _ = runner.run_pipeline()
+    peak_memory = tracemalloc.get_traced_memory()[1] if measure_memory else 0
+    if measure_memory:
+        tracemalloc.stop()
+    calls = backend.calls - calls_before
+    print(f"all-in-one: {sum(calls.values())} api calls, {sum((backend.throttles - throttles_before).values())} throttled, "
+          f"{len(summary['FailedRegions'])} failed regions" + (f", peak {peak_memory / 1048576:.1f} MiB" if measure_memory else ""))
+    print("  " + ", ".join(f"{op.split(':')[1]}={n}" for op, n in sorted(calls.items())))
+
+
+def print_report(run: int, stats: dict, elapsed: float, measure_memory: bool):
+    print(f"\nRun {run}: {elapsed:.2f}s")
+    print(f"{'stage':<17} {'invocations':>11} {'failed':>6} {'wall (s)':>9} {'api calls':>9} {'throttled':>9} {'peak MiB':>9}  calls by operation")
+    for stage in STAGES:
+        s = stats[stage]
+        peak = f"{s.peak_memory / 1048576:.1f}" if measure_memory else "-"
+        operations = ", ".join(f"{op.split(':')[1]}={n}" for op, n in sorted(s.calls.items()))
+        print(f"{stage:<17} {s.invocations:>11} {s.failures:>6} {s.elapsed:>9.3f} {sum(s.calls.values()):>9} {sum(s.throttles.values()):>9} {peak:>9}  {operations}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    topology = parser.add_argument_group("topology")
+    topology.add_argument('--regions', type=int, default=4)
+    topology.add_argument('--tgws', type=int, default=1, help="transit gateways per region")
+    topology.add_argument('--route-tables', type=int, default=4, help="route tables per transit gateway")
+    topology.add_argument('--attachments', type=int, default=200, help="attachments per region")
+    topology.add_argument('--accounts', type=int, default=50)
+    topology.add_argument('--tagged-fraction', type=float, default=0.0, help="fraction of attachments which already have a Name tag")
+    topology.add_argument('--cidrs-per-attachment', type=int, default=1)
+    backend_options = parser.add_argument_group("simulated backend")
+    backend_options.add_argument('--latency-ms', type=float, default=0.0, help="latency added to every API call")
+    backend_options.add_argument('--throttle-rate', type=float, default=0.0, help="probability that any API call is throttled")
+    backend_options.add_argument('--rate-limit', type=float, default=0.0, help="API calls per second per service and region before throttling")
+    backend_options.add_argument('--page-size', type=int, default=100, help="default page size of paginated EC2 operations")
+    parser.add_argument('--runs', type=int, default=1, help="run the pipeline several times, e.g. to exercise caches and delta mode")
+    parser.add_argument('--state-dir', help="local directory for the account cache, checkpoints and offloaded payloads")
+    parser.add_argument('--env', action='append', default=[], metavar="KEY=VALUE", help="extra Lambda environment variables")
+    parser.add_argument('--no-memory', action='store_true', help="skip peak memory tracking, which slows the handlers down")
+    parser.add_argument('--all-in-one', action='store_true', help="run the pipeline with the single process runner instead of the handlers")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    benchmark_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, os.path.join(benchmark_dir, '..', 'src'))
+    sys.path.insert(0, benchmark_dir)
+    from simulated_backend import SimulatedAWS, generate_topology
+
+    topology_data = generate_topology(
+        regions=args.regions, tgws=args.tgws, route_tables=args.route_tables, attachments=args.attachments,
+        accounts=args.accounts, tagged_fraction=args.tagged_fraction, cidrs_per_attachment=args.cidrs_per_attachment,
+        seed=args.seed
+    )
+    backend = SimulatedAWS(
+        topology_data, latency=args.latency_ms / 1000, throttle_rate=args.throttle_rate, rate_limit=args.rate_limit,
+        page_size=args.page_size, seed=args.seed
+    )
+
+    # The Lambdas read their configuration at import time
+    os.environ.update({
+        'AWS_ACCESS_KEY_ID': 'benchmark',
+        'AWS_SECRET_ACCESS_KEY': 'benchmark',
+        'AWS_DEFAULT_REGION': 'sim-region-1',
+        'POWERTOOLS_TRACE_DISABLED': '1',
+        'POWERTOOLS_LOG_LEVEL': 'WARNING',
+        'REGION_LIST': ",".join(topology_data["regions"]),
+        'TGW_LIST': '',
+        'ORGANIZATIONS_ROLE_ARN': 'arn:aws:iam::111111111111:role/tgw-attachment-tagger-organization-query-role',
+    })
+    if args.state_dir:
+        os.environ.update({
+            'ACCOUNT_CACHE_LOCATION': os.path.join(args.state_dir, 'account-cache'),
+            'CHECKPOINT_LOCATION': os.path.join(args.state_dir, 'checkpoints'),
+            'PAYLOAD_LOCATION': os.path.join(args.state_dir, 'payloads'),
+        })
+    for item in args.env:
+        key, _, value = item.partition("=")
+        os.environ[key] = value
+
+    backend.install()
+    if args.all_in_one:
+        import tgw_tagger_runner
+        tgw_tagger_runner.load_pipeline()
+    import tgw_tagger_organizations_account_query
+    import tgw_tagger_attachment_query
+    import tgw_tagger_rtb_query
+    import tgw_tagger_attachment_tagger
+    modules = {
+        "account-query": tgw_tagger_organizations_account_query,
+        "attachment-query": tgw_tagger_attachment_query,
+        "rtb-query": tgw_tagger_rtb_query,
+        "tagger": tgw_tagger_attachment_tagger,
+    }
+
+    total_attachments = sum(len(r["attachments"]) for r in topology_data["regions"].values())
+    print(f"Topology: {args.regions} regions x {args.tgws} TGWs x {args.route_tables} route tables, "
+          f"{args.attachments} attachments per region ({total_attachments} total), {args.accounts} accounts")
+    for run in range(1, args.runs + 1):
+        start = time.perf_counter()
+        if args.all_in_one:
+            run_all_in_one(tgw_tagger_runner, backend, not args.no_memory)
+            print(f"Run {run}: {time.perf_counter() - start:.2f}s")
+            continue
+        stats = run_pipeline(modules, backend, not args.no_memory)
+        print_report(run, stats, time.perf_counter() - start, not args.no_memory)
+
+    named = sum(1 for r in topology_data["regions"].values() for a in r["attachments"] if any(t["Key"] == "Name" for t in a["Tags"]))
+    print(f"\nAttachments with a Name tag after {args.runs} run(s): {named} of {total_attachments}")
+    backend.uninstall()
+
+
+if __name__ == '__main__':
+    main()
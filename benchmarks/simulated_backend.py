@@ -0,0 +1,382 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Local stand-in for the EC2, STS and Organizations APIs used by the tagger Lambdas.
+
+The backend hooks into botocore's before-send event, so every client created once it is
+installed (including clients from assumed role sessions) is answered locally. Requests
+still go through the real botocore serializers, parsers, paginators and retry handlers,
+so API call counts, pagination and throttling behave as they would against AWS.
+"""
+
+import datetime
+import ipaddress
+import json
+import random
+import threading
+import time
+from collections import Counter
+from xml.sax.saxutils import escape
+
+import botocore.session # type: ignore
+from botocore.awsrequest import AWSResponse # type: ignore
+
+THROTTLING_ERRORS = {
+    "ec2": ("RequestLimitExceeded", 503),
+    "sts": ("Throttling", 400),
+    "organizations": ("TooManyRequestsException", 400),
+}
+
+
+def generate_topology(regions: int = 4, tgws: int = 1, route_tables: int = 4, attachments: int = 200,
+                      accounts: int = 50, tagged_fraction: float = 0.0, cidrs_per_attachment: int = 1, seed: int = 0):
+    """
+    Generates a synthetic Organization and TGW topology.
+
+    Parameters:
+        regions (int): Number of regions
+        tgws (int): Transit gateways per region
+        route_tables (int): Route tables per transit gateway
+        attachments (int): VPC attachments per region, spread across the transit gateways
+        accounts (int): Active accounts in the Organization, owning the attachments
+        tagged_fraction (float): Fraction of attachments which already have a Name tag
+        cidrs_per_attachment (int): CIDRs propagated by each attachment
+        seed (int): Random seed, the same arguments always produce the same topology
+
+    Returns:
+        topology (dict): {"accounts": [...], "regions": {region: {...}}}
+    """
+    rng = random.Random(seed)
+    region_names = [f"sim-region-{i + 1}" for i in range(regions)]
+    account_list = [
+        {"Id": f"{100000000000 + i}", "Name": f"account-{i}", "Status": "ACTIVE"}
+        for i in range(accounts)
+    ]
+    # A few suspended accounts, which the account query skips
+    account_list += [{"Id": f"{900000000000 + i}", "Name": f"suspended-{i}", "Status": "SUSPENDED"} for i in range(max(1, accounts // 50))]
+
+    topology = {"accounts": account_list, "regions": {}}
+    created = datetime.datetime(2021, 1, 1, tzinfo=datetime.timezone.utc)
+    for r, region in enumerate(region_names):
+        tgw_ids = [f"tgw-{r:03d}{t:014d}" for t in range(tgws)]
+        tables = [
+            {"TransitGatewayRouteTableId": f"tgw-rtb-{r:03d}{t:06d}{n:08d}", "TransitGatewayId": tgw_id, "State": "available"}
+            for t, tgw_id in enumerate(tgw_ids) for n in range(route_tables)
+        ]
+        routes = {table["TransitGatewayRouteTableId"]: [] for table in tables}
+        region_attachments = []
+        cidr_counter = 0
+        for i in range(attachments):
+            tgw_index = i % tgws
+            attachment_id = f"tgw-attach-{r:03d}{i:014d}"
+            tags = [{"Key": "Name", "Value": f"existing-{i}"}] if rng.random() < tagged_fraction else []
+            region_attachments.append({
+                "TransitGatewayAttachmentId": attachment_id,
+                "TransitGatewayId": tgw_ids[tgw_index],
+                "TransitGatewayOwnerId": "111111111111",
+                "ResourceOwnerId": account_list[rng.randrange(accounts)]["Id"] if accounts else "000000000000",
+                "ResourceType": "vpc",
+                "ResourceId": f"vpc-{r:03d}{i:014d}",
+                "State": "available",
+                "CreationTime": created + datetime.timedelta(minutes=i),
+                "Tags": tags,
+            })
+            # Each attachment propagates its CIDRs to one route table of its transit gateway
+            table = tables[tgw_index * route_tables + (i // tgws) % route_tables]
+            for _ in range(cidrs_per_attachment):
+                cidr = f"10.{(cidr_counter // 256) % 256}.{cidr_counter % 256}.0/24"
+                cidr_counter += 1
+                routes[table["TransitGatewayRouteTableId"]].append({
+                    "DestinationCidrBlock": cidr,
+                    "TransitGatewayAttachments": [{
+                        "ResourceId": f"vpc-{r:03d}{i:014d}",
+                        "TransitGatewayAttachmentId": attachment_id,
+                        "ResourceType": "vpc",
+                    }],
+                    "Type": "propagated",
+                    "State": "active",
+                })
+        topology["regions"][region] = {
+            "attachments": region_attachments,
+            "route_tables": tables,
+            "routes": routes,
+        }
+    return topology
+
+
+class SimulatedError(Exception):
+    def __init__(self, code: str, message: str, status: int = 400):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+        self.status = status
+
+
+class _RawBody:
+    def __init__(self, body: bytes):
+        self.body = body
+
+    def stream(self, **kwargs):
+        yield self.body
+
+
+class SimulatedAWS:
+    """
+    Answers EC2, STS and Organizations requests from a generated topology.
+
+    Parameters:
+        topology (dict): Topology from generate_topology
+        latency (float): Seconds added to every request
+        throttle_rate (float): Probability that any request is throttled
+        rate_limit (float): Requests per second allowed per service and region before throttling, 0 for no limit
+        page_size (int): Default page size for paginated EC2 operations
+        seed (int): Random seed for throttling
+    """
+    def __init__(self, topology: dict, latency: float = 0.0, throttle_rate: float = 0.0, rate_limit: float = 0.0,
+                 page_size: int = 100, seed: int = 0):
+        self.topology = topology
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.rate_limit = rate_limit
+        self.page_size = page_size
+        self.calls = Counter()
+        self.throttles = Counter()
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._local = threading.local()
+        self._original_create_client = None
+        self._attachments = {
+            attachment["TransitGatewayAttachmentId"]: attachment
+            for region in topology["regions"].values() for attachment in region["attachments"]
+        }
+
+    def install(self):
+        """
+        Routes every botocore client created from now on to this backend
+        """
+        backend = self
+        original_create_client = botocore.session.Session.create_client
+        self._original_create_client = original_create_client
+
+        def create_client(session, service_name, *args, **kwargs):
+            client = original_create_client(session, service_name, *args, **kwargs)
+            region = client.meta.region_name
+            client.meta.events.register("before-parameter-build", backend._before_parameter_build)
+            client.meta.events.register("before-send", lambda request, **kw: backend._before_send(service_name, region, request))
+            return client
+
+        botocore.session.Session.create_client = create_client
+
+    def uninstall(self):
+        if self._original_create_client:
+            botocore.session.Session.create_client = self._original_create_client
+            self._original_create_client = None
+
+    def tags(self, attachment_id: str):
+        return {tag["Key"]: tag["Value"] for tag in self._attachments[attachment_id]["Tags"]}
+
+    def _before_parameter_build(self, model, params, **kwargs):
+        # before-send only receives the signed HTTP request, keep the API parameters for it
+        self._local.call = (model, dict(params))
+
+    def _before_send(self, service: str, region: str, request):
+        operation_model, params = self._local.call
+        key = f"{service}:{operation_model.name}"
+        with self._lock:
+            self.calls[key] += 1
+            throttled = self._throttled(service, region)
+            if throttled:
+                self.throttles[key] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            code, status = THROTTLING_ERRORS.get(service, ("Throttling", 400))
+            return self._error(operation_model, request, SimulatedError(code, "Rate exceeded", status))
+        handler = getattr(self, f"_{service}_{operation_model.name}", None)
+        if handler is None:
+            return self._error(operation_model, request, SimulatedError("NotImplemented", f"{key} is not simulated"))
+        try:
+            result = handler(region, params)
+        except SimulatedError as e:
+            return self._error(operation_model, request, e)
+        return self._response(operation_model, request, result)
+
+    def _throttled(self, service: str, region: str):
+        if self.throttle_rate and self._random.random() < self.throttle_rate:
+            return True
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        tokens, last = self._buckets.get((service, region), (self.rate_limit, now))
+        tokens = min(self.rate_limit, tokens + (now - last) * self.rate_limit)
+        if tokens < 1:
+            self._buckets[(service, region)] = (tokens, now)
+            return True
+        self._buckets[(service, region)] = (tokens - 1, now)
+        return False
+
+    # Protocol serialization
+
+    def _response(self, operation_model, request, result: dict):
+        protocol = operation_model.service_model.protocol
+        if protocol == "json":
+            body = json.dumps(result, default=lambda x: x.timestamp()).encode("utf-8")
+            headers = {"Content-Type": "application/x-amz-json-1.1", "x-amzn-RequestId": "simulated"}
+        else:
+            output_shape = operation_model.output_shape
+            members = self._xml_members(output_shape, result) if output_shape else ""
+            wrapper = output_shape.serialization.get("resultWrapper") if output_shape else None
+            if wrapper:
+                members = f"<{wrapper}>{members}</{wrapper}>"
+            namespace = operation_model.service_model.metadata.get("xmlNamespace", "")
+            body = (f'<{operation_model.name}Response xmlns="{namespace}">{members}'
+                    f"<requestId>simulated</requestId></{operation_model.name}Response>").encode("utf-8")
+            headers = {"Content-Type": "text/xml"}
+        return AWSResponse(request.url, 200, headers, _RawBody(body))
+
+    def _error(self, operation_model, request, error: SimulatedError):
+        protocol = operation_model.service_model.protocol
+        if protocol == "json":
+            body = json.dumps({"__type": error.code, "message": error.message}).encode("utf-8")
+            headers = {"Content-Type": "application/x-amz-json-1.1", "x-amzn-RequestId": "simulated"}
+        elif protocol == "ec2":
+            body = (f"<Response><Errors><Error><Code>{error.code}</Code><Message>{escape(error.message)}</Message>"
+                    f"</Error></Errors><RequestID>simulated</RequestID></Response>").encode("utf-8")
+            headers = {"Content-Type": "text/xml"}
+        else:
+            body = (f"<ErrorResponse><Error><Type>Sender</Type><Code>{error.code}</Code><Message>{escape(error.message)}</Message>"
+                    f"</Error><RequestId>simulated</RequestId></ErrorResponse>").encode("utf-8")
+            headers = {"Content-Type": "text/xml"}
+        return AWSResponse(request.url, error.status, headers, _RawBody(body))
+
+    def _xml_members(self, shape, value: dict):
+        return "".join(
+            self._xml(member_shape, value[name], member_shape.serialization.get("name", name))
+            for name, member_shape in shape.members.items() if value.get(name) is not None
+        )
+
+    def _xml(self, shape, value, tag: str):
+        if shape.type_name == "structure":
+            inner = self._xml_members(shape, value)
+        elif shape.type_name == "list":
+            item_tag = shape.member.serialization.get("name", "member")
+            inner = "".join(self._xml(shape.member, item, item_tag) for item in value)
+        elif shape.type_name == "timestamp":
+            inner = value.isoformat() if isinstance(value, datetime.datetime) else str(value)
+        elif shape.type_name == "boolean":
+            inner = "true" if value else "false"
+        else:
+            inner = escape(str(value))
+        return f"<{tag}>{inner}</{tag}>"
+
+    # EC2
+
+    def _region(self, region: str):
+        if region not in self.topology["regions"]:
+            raise SimulatedError("UnauthorizedOperation", f"Region {region} is not part of the simulated topology")
+        return self.topology["regions"][region]
+
+    @staticmethod
+    def _filters(params: dict):
+        return {f["Name"]: f["Values"] for f in params.get("Filters", [])}
+
+    def _page(self, items: list, params: dict, key: str, maximum: int = 1000):
+        start = int(params.get("NextToken") or 0)
+        size = min(params.get("MaxResults") or self.page_size, maximum)
+        result = {key: items[start:start + size]}
+        if start + size < len(items):
+            result["NextToken"] = str(start + size)
+        return result
+
+    def _ec2_DescribeTransitGatewayAttachments(self, region: str, params: dict):
+        filters = self._filters(params)
+        attachments = [
+            a for a in self._region(region)["attachments"]
+            if a["State"] in filters.get("state", [a["State"]])
+            and a["ResourceType"] in filters.get("resource-type", [a["ResourceType"]])
+            and a["TransitGatewayId"] in filters.get("transit-gateway-id", [a["TransitGatewayId"]])
+        ]
+        return self._page(attachments, params, "TransitGatewayAttachments")
+
+    def _ec2_DescribeTransitGatewayRouteTables(self, region: str, params: dict):
+        filters = self._filters(params)
+        tables = [t for t in self._region(region)["route_tables"] if t["State"] in filters.get("state", [t["State"]])]
+        return self._page(tables, params, "TransitGatewayRouteTables")
+
+    def _ec2_SearchTransitGatewayRoutes(self, region: str, params: dict):
+        routes = self._region(region)["routes"].get(params["TransitGatewayRouteTableId"])
+        if routes is None:
+            raise SimulatedError("InvalidRouteTableID.NotFound", f"{params['TransitGatewayRouteTableId']} does not exist")
+        filters = self._filters(params)
+        if not filters:
+            raise SimulatedError("MissingParameter", "The request must contain the parameter Filters")
+        matches = []
+        for route in routes:
+            attachment_ids = [a["TransitGatewayAttachmentId"] for a in route.get("TransitGatewayAttachments", [])]
+            network = ipaddress.ip_network(route["DestinationCidrBlock"])
+            if "attachment.transit-gateway-attachment-id" in filters and not set(attachment_ids) & set(filters["attachment.transit-gateway-attachment-id"]):
+                continue
+            if route["Type"] not in filters.get("type", [route["Type"]]) or route["State"] not in filters.get("state", [route["State"]]):
+                continue
+            if "route-search.exact-match" in filters and not any(network == ipaddress.ip_network(v) for v in filters["route-search.exact-match"]):
+                continue
+            if "route-search.subnet-of-match" in filters and not any(
+                    network.version == ipaddress.ip_network(v).version and network.subnet_of(ipaddress.ip_network(v))
+                    for v in filters["route-search.subnet-of-match"]):
+                continue
+            matches.append(route)
+        maximum = min(params.get("MaxResults") or 1000, 1000)
+        return {"Routes": matches[:maximum], "AdditionalRoutesAvailable": len(matches) > maximum}
+
+    def _ec2_CreateTags(self, region: str, params: dict):
+        region_attachments = {a["TransitGatewayAttachmentId"] for a in self._region(region)["attachments"]}
+        missing = [r for r in params["Resources"] if r not in region_attachments]
+        if missing:
+            raise SimulatedError("InvalidTransitGatewayAttachmentID.NotFound", f"The transitGatewayAttachment ID '{missing[0]}' does not exist")
+        with self._lock:
+            for resource in params["Resources"]:
+                tags = self._attachments[resource]["Tags"]
+                for tag in params["Tags"]:
+                    tags[:] = [t for t in tags if t["Key"] != tag["Key"]] + [tag]
+        return {}
+
+    # STS and Organizations
+
+    def _sts_AssumeRole(self, region: str, params: dict):
+        return {
+            "Credentials": {
+                "AccessKeyId": "ASIASIMULATED",
+                "SecretAccessKey": "simulated",
+                "SessionToken": "simulated",
+                "Expiration": datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1),
+            },
+            "AssumedRoleUser": {"AssumedRoleId": "AROASIMULATED:session", "Arn": params["RoleArn"]},
+        }
+
+    def _organizations_ListAccounts(self, region: str, params: dict):
+        accounts = [
+            {
+                "Id": a["Id"],
+                "Arn": f"arn:aws:organizations::111111111111:account/o-simulated/{a['Id']}",
+                "Email": f"{a['Id']}@example.com",
+                "Name": a["Name"],
+                "Status": a["Status"],
+            }
+            for a in self.topology["accounts"]
+        ]
+        return self._page(accounts, params, "Accounts", maximum=20)
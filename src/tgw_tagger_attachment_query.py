@@ -15,16 +15,149 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import boto3 # type: ignore
-import logging
-import sys
-import traceback
 import os
 import json
+import gzip
+import threading
+import time
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config # type: ignore
 from aws_lambda_powertools import Tracer # type: ignore
 from aws_lambda_powertools import Logger # type: ignore
+from aws_lambda_powertools import Metrics # type: ignore
+from aws_lambda_powertools.metrics import MetricUnit # type: ignore
 
 tracer = Tracer(service="tgw-tagger-attachment-query")
 logger = Logger(service="tgw-tagger-attachment-query")
+metrics = Metrics(namespace="TGWAttachmentTagger", service="tgw-tagger-attachment-query")
+
+EC2_MAX_POOL_CONNECTIONS = int(os.environ.get('EC2_MAX_POOL_CONNECTIONS', '10'))
+EC2_TCP_KEEPALIVE = os.environ.get('EC2_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+# Adaptive retries give every client (one per region) a token bucket which slows requests down
+# when the API throttles, and retry throttled calls within a bounded retry budget
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '10'))
+
+retry_config = Config(
+    retries={
+        'mode': AWS_RETRY_MODE,
+        'total_max_attempts': AWS_MAX_ATTEMPTS
+    }
+)
+
+# Error codes counted as throttling in the run metrics
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'EC2ThrottledException'
+}
+
+# Counters for the current invocation, published as a single metrics record when the handler finishes
+run_counters = Counter()
+run_counters_lock = threading.Lock()
+
+def add_run_counter(name: str, value: float = 1):
+    """
+    Adds to a counter published in the run metrics. Safe to call from several threads
+    
+    Parameters:
+        name (str): The metric name, names ending in "Time" are published in milliseconds
+        value (float): The amount to add
+    """
+    with run_counters_lock:
+        run_counters[name] += value
+
+def count_api_call(model, **kwargs):
+    """
+    botocore before-call hook, counting API calls by operation. Paginated operations count one call per page
+    """
+    add_run_counter("ApiCalls")
+    add_run_counter(f"{model.name}Calls")
+
+def count_api_attempt(parsed_response, **kwargs):
+    """
+    botocore response-received hook, counting every HTTP attempt including retries, and throttled attempts
+    """
+    add_run_counter("ApiAttempts")
+    if parsed_response and parsed_response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        add_run_counter("ApiThrottles")
+
+def instrument_client(client):
+    """
+    Registers the run metrics hooks on a boto client
+    
+    Parameters:
+        client: The boto client
+    
+    Returns:
+        The same boto client
+    """
+    client.meta.events.register('before-call', count_api_call)
+    client.meta.events.register('response-received', count_api_attempt)
+    return client
+
+@contextmanager
+def timed_phase(name: str):
+    """
+    Adds the time spent in the block to the {name}Time run counter, in milliseconds
+    
+    Parameters:
+        name (str): The phase name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_run_counter(f"{name}Time", (time.perf_counter() - start) * 1000)
+
+def timed_iter(iterable, name: str):
+    """
+    Yields the items of an iterable, adding the time spent producing them to the {name}Time run counter.
+    Unlike timed_phase around a loop, time the consumer spends on each item is not counted
+    
+    Parameters:
+        iterable: The iterable, e.g. a paginator
+        name (str): The phase name
+    """
+    iterator = iter(iterable)
+    while True:
+        with timed_phase(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+def publish_run_metrics(handler):
+    """
+    Decorator adding the run counters to the metrics when the handler returns or fails, so they are
+    flushed as one record by metrics.log_metrics. ApiRetries is the number of attempts beyond the first of each call
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            with run_counters_lock:
+                counters = dict(run_counters)
+                run_counters.clear()
+            if 'ApiAttempts' in counters:
+                counters['ApiRetries'] = max(0, counters['ApiAttempts'] - counters.get('ApiCalls', 0))
+            for name, value in sorted(counters.items()):
+                metrics.add_metric(name=name, unit=MetricUnit.Milliseconds if name.endswith("Time") else MetricUnit.Count, value=value)
+    return wrapper
+
+ec2_clients = {}
+ec2_clients_lock = threading.Lock()
 
 REGION_LIST = os.environ.get('REGION_LIST').split(",")
 ORIGINAL_TGW_LIST = os.environ.get('TGW_LIST')
@@ -32,15 +165,103 @@ ORIGINAL_TGW_LIST = os.environ.get('TGW_LIST')
 if not REGION_LIST:
     raise RuntimeError("Environment Variable REGION_LIST is empty - At least one region must be specified")
 
+# Maximum number of regions queried in parallel
+REGION_CONCURRENCY = max(1, int(os.environ.get('REGION_CONCURRENCY', '8')))
+# Regions with more attachments than this are split into shards, each processed by its own Map iteration. 0 disables sharding
+SHARD_SIZE = int(os.environ.get('SHARD_SIZE', '0'))
+
 if ORIGINAL_TGW_LIST:
     tgw_list = ORIGINAL_TGW_LIST.split(",")
 else:
     tgw_list = []
 
-@tracer.capture_method
+# In delta mode only new or untagged attachments are passed on to the RTB query and tagger
+DELTA_MODE = os.environ.get('DELTA_MODE', 'false').lower() == 'true'
+# Where per-region checkpoints are kept: "s3://bucket/prefix" or a local directory
+CHECKPOINT_LOCATION = os.environ.get('CHECKPOINT_LOCATION', '')
+
+if DELTA_MODE and not CHECKPOINT_LOCATION:
+    raise RuntimeError("Environment Variable CHECKPOINT_LOCATION must be set when DELTA_MODE is enabled")
+
+# "missing" tags attachments without a Name tag, "reconcile" also rewrites Name tags which differ from the CIDR and account name
+TAG_MODE = os.environ.get('TAG_MODE', 'missing').lower()
+
+if TAG_MODE not in ("missing", "reconcile"):
+    raise RuntimeError(f"Environment Variable TAG_MODE must be 'missing' or 'reconcile', got '{TAG_MODE}'")
+
+# Where region payloads too large for the Step Functions state are offloaded: "s3://bucket/prefix" or a local directory
+PAYLOAD_LOCATION = os.environ.get('PAYLOAD_LOCATION', '').rstrip("/")
+# Regions whose compact JSON payload is at least this size are offloaded, smaller regions stay inline
+PAYLOAD_OFFLOAD_THRESHOLD_BYTES = int(os.environ.get('PAYLOAD_OFFLOAD_THRESHOLD_BYTES', '8192'))
+PAYLOAD_COMPRESSION = os.environ.get('PAYLOAD_COMPRESSION', 'true').lower() == 'true'
+# How attachments are passed to the next stages: "columnar" (see encode_attachments) or "json", a list of dictionaries
+PAYLOAD_ENCODING = os.environ.get('PAYLOAD_ENCODING', 'columnar').lower()
+
+if PAYLOAD_ENCODING not in ("columnar", "json"):
+    raise RuntimeError(f"Environment Variable PAYLOAD_ENCODING must be columnar or json, got {PAYLOAD_ENCODING}")
+
+s3_client = None
+
+class S3CheckpointStore:
+    """
+    Stores checkpoints as objects in an S3 bucket
+    """
+    def __init__(self, bucket: str, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = get_s3_client()
+
+    def _object_key(self, key: str):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def load(self, key: str):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read().decode('utf-8')
+
+    def save(self, key: str, body: str):
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=body.encode('utf-8'), ContentType='application/json')
+
+class LocalFileCheckpointStore:
+    """
+    Stores checkpoints as files in a local directory, for testing outside of AWS
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def load(self, key: str):
+        try:
+            with open(os.path.join(self.directory, key), encoding='utf-8') as checkpoint_file:
+                return checkpoint_file.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, body: str):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, key), 'w', encoding='utf-8') as checkpoint_file:
+            checkpoint_file.write(body)
+
+def get_checkpoint_store(location: str):
+    """
+    Returns the checkpoint store for the configured location
+    
+    Parameters:
+        location (str): "s3://bucket/prefix" or a local directory
+    
+    Returns:
+        The checkpoint store
+    """
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        return S3CheckpointStore(bucket, prefix)
+    return LocalFileCheckpointStore(location)
+
 def get_ec2_client(region: str):
     """
-    Create a regional EC2 boto client
+    Return the regional EC2 boto client, creating it on first use.
+    Clients are cached at module level so warm invocations reuse their connection pool
     
     Parameters: 
         region (str): the AWS region where the client should be created
@@ -48,23 +269,212 @@ def get_ec2_client(region: str):
     Returns:
         boto3 ec2 client for the target region
     """
-    return boto3.client('ec2', region_name=region)
+    with ec2_clients_lock:
+        if region not in ec2_clients:
+            ec2_clients[region] = instrument_client(
+                boto3.client(
+                    'ec2',
+                    region_name=region,
+                    config=retry_config.merge(
+                        Config(
+                            max_pool_connections=EC2_MAX_POOL_CONNECTIONS,
+                            tcp_keepalive=EC2_TCP_KEEPALIVE
+                        )
+                    )
+                )
+            )
+        return ec2_clients[region]
     
-@tracer.capture_method
-def list_transit_gateway_attachments(account_list: list, region: str):
+def build_account_index(account_list: list):
     """
-    Returns all TGW attachments for the specified Region
+    Builds a lookup of account ID -> account Name, so resolving the owner of an attachment is a single dictionary lookup
     
     Parameters:
         account_list (list): List containing dictionaries of account IDs and their Name
-        region (str): The AWS region to process
     
     Returns:
-        result_object (list): List of dictionaries with TGW attachment data including the owning account name    
+        account_index (dict): Dictionary of account IDs and their Name
+    """
+    return {account['id']: account['name'] for account in account_list}
+
+def get_account_index(event: dict):
+    """
+    Returns the account index from the Lambda event, building it from AccountDetails when the
+    event was produced by an earlier version of the Organizations account query
+    
+    Parameters:
+        event (dict): The Lambda event object
+    
+    Returns:
+        account_index (dict): Dictionary of account IDs and their Name
+    """
+    if 'AccountIndex' in event:
+        return event['AccountIndex']
+    return build_account_index(event.get('AccountDetails') or [])
+
+def get_s3_client():
+    """
+    Return the S3 boto client used for checkpoints and offloaded payloads, creating it on first use
+    
+    Returns:
+        boto3 s3 client
+    """
+    global s3_client
+    if s3_client is None:
+        s3_client = instrument_client(boto3.client('s3', config=retry_config))
+    return s3_client
+
+@tracer.capture_method
+def write_payload(location: str, body: str):
+    """
+    Writes a region payload, compressing it when the location ends in .gz
+    
+    Parameters:
+        location (str): "s3://bucket/key" or a local file path
+        body (str): The JSON encoded payload
+    """
+    data = body.encode('utf-8')
+    if location.endswith(".gz"):
+        data = gzip.compress(data)
+    try:
+        if location.startswith("s3://"):
+            bucket, _, key = location[len("s3://"):].partition("/")
+            get_s3_client().put_object(Bucket=bucket, Key=key, Body=data)
+        else:
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, 'wb') as payload_file:
+                payload_file.write(data)
+    except:
+        logger.exception(f"Error writing payload {location}")
+        raise RuntimeError(f"Error writing payload {location}")
+
+def encode_attachments(attachments: list):
+    """
+    Encodes attachments in the columnar layout used between the Lambdas: one list per field instead of one dictionary
+    per attachment. Fields with repeated values (transit gateway, account, the "MISSING" sentinels) are dictionary
+    encoded, storing each distinct value once and an index per attachment, and the account name is stored once
+    per account ID. Attachments with differing fields are returned unchanged
+
+    Parameters:
+        attachments (list): List of dictionaries with TGW attachment data
+
+    Returns:
+        payload (dict): {"Encoding": "columnar", "Count": n, "Columns": {field: column}}
+    """
+    fields = list(attachments[0]) if attachments else []
+    if any(list(x) != fields for x in attachments):
+        return attachments
+    columns = {}
+    for field in fields:
+        values = [x[field] for x in attachments]
+        lookup = {}
+        index = [lookup.setdefault(value, len(lookup)) for value in values]
+        if len(lookup) * 2 <= len(values):
+            columns[field] = {"Values": list(lookup), "Index": index}
+        else:
+            columns[field] = values
+    account_ids = columns.get('accountId')
+    if isinstance(account_ids, dict) and 'accountName' in columns:
+        # Every attachment owned by an account has the same account name, so names are stored per account ID
+        names = {}
+        for account_id, account_name in zip(account_ids['Index'], (x['accountName'] for x in attachments)):
+            if names.setdefault(account_id, account_name) != account_name:
+                break
+        else:
+            columns['accountName'] = {"Key": "accountId", "Values": [names[i] for i in range(len(account_ids['Values']))]}
+    return {"Encoding": "columnar", "Count": len(attachments), "Columns": columns}
+
+@tracer.capture_method
+def offload_region_attachments(region: str, attachments, run_id: str, shard: int = None):
+    """
+    Returns the Map item for a region, writing the attachments to the payload store when they are too large to pass inline
+    
+    Parameters:
+        region (str): The AWS region
+        attachments: The encoded region attachments, see encode_region_attachments
+        run_id (str): Identifies this run in the payload store
+        shard (int): The shard number when the region is sharded
+    
+    Returns:
+        Either the encoded attachments or a dictionary with the PayloadLocation
+    """
+    body = json.dumps(attachments, separators=(',', ':'))
+    if len(body) < PAYLOAD_OFFLOAD_THRESHOLD_BYTES:
+        return attachments
+    region_path = f"{region}/shard-{shard}" if shard is not None else region
+    payload_location = f"{PAYLOAD_LOCATION}/{run_id}/{region_path}/attachments.json{'.gz' if PAYLOAD_COMPRESSION else ''}"
+    logger.info(f"Offloading {len(body)} bytes of attachments for region {region} to {payload_location}")
+    with timed_phase("PayloadWrite"):
+        write_payload(payload_location, body)
+    add_run_counter("PayloadsOffloaded")
+    return {"PayloadLocation": payload_location}
+
+def encode_region_attachments(attachments: list):
+    """
+    Returns the attachments in the PAYLOAD_ENCODING passed to the next stages
+    
+    Parameters:
+        attachments (list): List of dictionaries with TGW attachment data
+    """
+    if PAYLOAD_ENCODING == "columnar":
+        return encode_attachments(attachments)
+    return attachments
+
+def build_map_items(region: str, attachments: list, run_id: str):
+    """
+    Returns the Map items for a region. Regions with more than SHARD_SIZE attachments are split into shards,
+    which name their region explicitly as the attachments key alone no longer identifies a single item
+    
+    Parameters:
+        region (str): The AWS region
+        attachments (list): List of dictionaries with TGW attachment data
+        run_id (str): Identifies this run in the payload store
+    
+    Returns:
+        map_items (list): The Map items for the region
+    """
+    if SHARD_SIZE <= 0 or len(attachments) <= SHARD_SIZE:
+        payload = encode_region_attachments(attachments)
+        if PAYLOAD_LOCATION:
+            payload = offload_region_attachments(region, payload, run_id)
+        return [
+            {
+                region: payload
+            }
+        ]
+    shards = [attachments[i:i + SHARD_SIZE] for i in range(0, len(attachments), SHARD_SIZE)]
+    logger.info(f"Splitting {len(attachments)} attachments for region {region} into {len(shards)} shards")
+    map_items = []
+    for shard, shard_attachments in enumerate(shards):
+        payload = encode_region_attachments(shard_attachments)
+        if PAYLOAD_LOCATION:
+            payload = offload_region_attachments(region, payload, run_id, shard)
+        map_items.append(
+            {
+                "Region": region,
+                "Shard": shard,
+                "ShardCount": len(shards),
+                region: payload
+            }
+        )
+    return map_items
+
+@tracer.capture_method
+def iter_transit_gateway_attachments(account_index: dict, region: str, checkpoint: dict = None):
+    """
+    Yields the TGW attachments for the specified Region as each page of results arrives,
+    so later stages can start on the first page while the next ones are fetched
+    
+    Parameters:
+        account_index (dict): Dictionary of account IDs and their Name
+        region (str): The AWS region to process
+        checkpoint (dict): Optional dictionary which is filled with the creation time and Name tag of each attachment
+    
+    Yields:
+        attachment (dict): TGW attachment data including the owning account name
     """
     logger.info(f"Getting list of TGW Attachments for region {region}")
     ec2 = get_ec2_client(region)
-    result_object = []
     try:
         # Get all TGW attachments in the region which have type: vpc and are available
         paginator = ec2.get_paginator('describe_transit_gateway_attachments')
@@ -88,37 +498,154 @@ def list_transit_gateway_attachments(account_list: list, region: str):
         logger.exception(f"Error getting list of TGW attachments for region {region}")
         raise RuntimeError(f"Error getting list of TGW attachments for region {region}")
 
-    for page in iterator:
+    listed = 0
+    excluded = 0
+    for page in timed_iter(iterator, "AttachmentQuery"):
         for attachment in page['TransitGatewayAttachments']:
             # Check TGW has not been excluded from processing
             if attachment['TransitGatewayId'] not in tgw_list:
-                logger.info(f"Processing Attachment: {attachment['TransitGatewayAttachmentId']}")
+                logger.debug(f"Processing Attachment: {attachment['TransitGatewayAttachmentId']}")
                 tgw_name = "MISSING"
                 for i in attachment['Tags']:
                     # Check whether Name tag exists
                     if "Name" == i['Key']:
                         tgw_name = i['Value']   
-                account_name = "MISSING"
-                # Check account list object for a match against the TGW resource owner
-                for account in [x for x in account_list if x['id'] == attachment['ResourceOwnerId']]:
-                    account_name = account['name']           
-                result_object.append(
-                    {
-                        "tgwId": attachment['TransitGatewayId'], 
-                        "attachmentId": attachment['TransitGatewayAttachmentId'], 
-                        "accountId": attachment['ResourceOwnerId'],
-                        "accountName": account_name, 
+                # Check account index for a match against the TGW resource owner
+                account_name = account_index.get(attachment['ResourceOwnerId'], "MISSING")
+                if checkpoint is not None:
+                    checkpoint[attachment['TransitGatewayAttachmentId']] = {
+                        "createdAt": attachment['CreationTime'].isoformat() if 'CreationTime' in attachment else None,
                         "nametag": tgw_name
                     }
-                )
-    return result_object
+                listed += 1
+                yield {
+                    "tgwId": attachment['TransitGatewayId'], 
+                    "attachmentId": attachment['TransitGatewayAttachmentId'], 
+                    "accountId": attachment['ResourceOwnerId'],
+                    "accountName": account_name, 
+                    "nametag": tgw_name
+                }
+            else:
+                excluded += 1
+    logger.info(f"Found {listed} TGW attachments in region {region}, excluded {excluded}")
+    add_run_counter("AttachmentsListed", listed)
+    add_run_counter("AttachmentsExcluded", excluded)
+
+@tracer.capture_method
+def read_checkpoint(checkpoint_store, region: str):
+    """
+    Returns the attachments recorded for the region by the previous run
+    
+    Parameters:
+        checkpoint_store: The checkpoint store
+        region (str): The AWS region to process
+    
+    Returns:
+        checkpoint (dict): Dictionary of attachment IDs and their creation time and Name tag, empty if there is no checkpoint
+    """
+    try:
+        body = checkpoint_store.load(f"checkpoint-{region}.json")
+        if body is None:
+            return {}
+        return json.loads(body)['Attachments']
+    except:
+        # Without a readable checkpoint every attachment is treated as new, which is the same as a full run,
+        # and the checkpoint is replaced once the region has been read
+        logger.exception(f"Error reading checkpoint for region {region}")
+        return {}
+
+@tracer.capture_method
+def write_checkpoint(checkpoint_store, region: str, checkpoint: dict):
+    """
+    Saves the attachments seen in the region during this run
+    
+    Parameters:
+        checkpoint_store: The checkpoint store
+        region (str): The AWS region to process
+        checkpoint (dict): Dictionary of attachment IDs and their creation time and Name tag
+    """
+    try:
+        checkpoint_store.save(f"checkpoint-{region}.json", json.dumps({"Region": region, "Attachments": checkpoint}, separators=(',', ':')))
+    except:
+        logger.exception(f"Error writing checkpoint for region {region}")
 
+@tracer.capture_method
+def iter_changed_transit_gateway_attachments(account_index: dict, region: str, checkpoint_store, full_run: bool):
+    """
+    Yields the TGW attachments for the region which are new since the last checkpoint or have no Name tag.
+    Once every attachment has been seen a new checkpoint is saved, so it is not saved if iteration stops early
+    
+    Parameters:
+        account_index (dict): Dictionary of account IDs and their Name
+        region (str): The AWS region to process
+        checkpoint_store: The checkpoint store
+        full_run (bool): Yield every attachment, while still saving a new checkpoint
+    
+    Yields:
+        attachment (dict): TGW attachment data including the owning account name
+    """
+    with timed_phase("CheckpointRead"):
+        previous_checkpoint = read_checkpoint(checkpoint_store, region)
+    checkpoint = {}
+    changed = 0
+    for attachment in iter_transit_gateway_attachments(account_index, region, checkpoint):
+        if full_run or attachment['attachmentId'] not in previous_checkpoint or "MISSING" == attachment['nametag']:
+            changed += 1
+            yield attachment
+    logger.info(f"Region {region}: {changed} of {len(checkpoint)} attachments are new or untagged")
+    add_run_counter("AttachmentsUnchanged", len(checkpoint) - changed)
+    with timed_phase("CheckpointWrite"):
+        write_checkpoint(checkpoint_store, region, checkpoint)
+
+def iter_region_attachments(account_index: dict, region: str, checkpoint_store=None, full_run: bool = False):
+    """
+    Returns an iterator over the TGW attachments to process for the region: every attachment, or in delta mode only those which are new or untagged.
+    In reconcile mode every attachment is processed, as a CIDR change does not show in the attachment, and only the checkpoint is kept up to date
+    
+    Parameters:
+        account_index (dict): Dictionary of account IDs and their Name
+        region (str): The AWS region to process
+        checkpoint_store: The checkpoint store in delta mode, otherwise None
+        full_run (bool): Yield every attachment in delta mode, while still saving a new checkpoint
+    
+    Returns:
+        Iterator of dictionaries with TGW attachment data including the owning account name
+    """
+    if checkpoint_store is not None:
+        return iter_changed_transit_gateway_attachments(account_index, region, checkpoint_store, full_run or "reconcile" == TAG_MODE)
+    return iter_transit_gateway_attachments(account_index, region)
+
+def query_region_attachments(account_index: dict, region: str, checkpoint_store=None, full_run: bool = False):
+    """
+    Returns the TGW attachments to process for the region: every attachment, or in delta mode only those which are new or untagged
+    
+    Parameters:
+        account_index (dict): Dictionary of account IDs and their Name
+        region (str): The AWS region to process
+        checkpoint_store: The checkpoint store in delta mode, otherwise None
+        full_run (bool): Return every attachment in delta mode, while still saving a new checkpoint
+    
+    Returns:
+        result_object (list): List of dictionaries with TGW attachment data including the owning account name
+    """
+    return list(iter_region_attachments(account_index, region, checkpoint_store, full_run))
+
+@metrics.log_metrics
+@publish_run_metrics
 @tracer.capture_lambda_handler
-@logger.inject_lambda_context(log_event=True)
+@logger.inject_lambda_context
 def lambda_handler(event, context):
     """
     Queries the EC2 API for Transit Gateway Attachment details for each configured region, 
     before returning a dictionary of lists with TGW attachment information.
+    Regions are queried in parallel, up to REGION_CONCURRENCY at a time. A region which fails
+    is logged and left out of MapInput so the remaining regions can still be processed, and is listed in
+    FailedRegions, which fails the Step Function execution once the remaining regions have been tagged.
+    In delta mode only new or untagged attachments are returned, unless "FullRun": true is set in the event.
+    When PAYLOAD_LOCATION is set, large regions are written to the payload store and only their location is returned.
+    When SHARD_SIZE is set, large regions are split into several Map items so their work is spread across Map iterations.
+    API calls, attachments listed and the time spent in each phase are published as one metrics record. Phase times
+    other than RegionQueryTime are summed across regions, so can exceed the wall clock time.
     
     Parameters:
         event (dict): The Lambda event object
@@ -129,13 +656,33 @@ def lambda_handler(event, context):
     """
     response_data = {}
     response_data['MapInput'] = []
-    if event['AccountDetails']:
-        for region in REGION_LIST:
-            logger.info(f"Processing Region: {region}")
-            result = list_transit_gateway_attachments(event['AccountDetails'], region)
-            response_data['MapInput'].append(
-                {
-                    region: result
-                }
-            ) 
-    return(response_data)
+    # The account index is built once and shared by every region
+    account_index = get_account_index(event)
+    if account_index:
+        add_run_counter("Regions", len(REGION_LIST))
+        region_query_start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=min(REGION_CONCURRENCY, len(REGION_LIST))) as executor:
+            futures = []
+            checkpoint_store = get_checkpoint_store(CHECKPOINT_LOCATION) if DELTA_MODE else None
+            full_run = bool(event.get('FullRun'))
+            for region in REGION_LIST:
+                logger.info(f"Processing Region: {region}")
+                futures.append((region, executor.submit(query_region_attachments, account_index, region, checkpoint_store, full_run)))
+        add_run_counter("RegionQueryTime", (time.perf_counter() - region_query_start) * 1000)
+        # Results are collected in REGION_LIST order, regardless of which region finished first
+        failed_regions = []
+        for region, future in futures:
+            try:
+                result = future.result()
+            except Exception:
+                logger.exception(f"Error processing region {region}")
+                failed_regions.append(region)
+                continue
+            response_data['MapInput'].extend(build_map_items(region, result, context.aws_request_id))
+        add_run_counter("MapItems", len(response_data['MapInput']))
+        add_run_counter("FailedRegions", len(failed_regions))
+        if failed_regions:
+            response_data['FailedRegions'] = failed_regions
+            if not response_data['MapInput']:
+                raise RuntimeError(f"Error getting list of TGW attachments for all regions: {', '.join(failed_regions)}")
+    return(response_data)
\ No newline at end of file
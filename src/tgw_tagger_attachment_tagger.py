@@ -15,21 +15,147 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import boto3 # type: ignore
-import logging
-import sys
-import traceback
 import os
 import json
+import gzip
+import threading
+import time
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from botocore.config import Config # type: ignore
 from aws_lambda_powertools import Tracer # type: ignore
 from aws_lambda_powertools import Logger # type: ignore
+from aws_lambda_powertools import Metrics # type: ignore
+from aws_lambda_powertools.metrics import MetricUnit # type: ignore
 
 tracer = Tracer(service="tgw_tagger_attachment_tagger")
 logger = Logger(service="tgw_tagger_attachment_tagger")
+metrics = Metrics(namespace="TGWAttachmentTagger", service="tgw_tagger_attachment_tagger")
+
+EC2_MAX_POOL_CONNECTIONS = int(os.environ.get('EC2_MAX_POOL_CONNECTIONS', '10'))
+EC2_TCP_KEEPALIVE = os.environ.get('EC2_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+# Adaptive retries give every client (one per region) a token bucket which slows requests down
+# when the API throttles, and retry throttled calls within a bounded retry budget
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '10'))
+
+retry_config = Config(
+    retries={
+        'mode': AWS_RETRY_MODE,
+        'total_max_attempts': AWS_MAX_ATTEMPTS
+    }
+)
+
+# Error codes counted as throttling in the run metrics
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'EC2ThrottledException'
+}
+
+# Counters for the current invocation, published as a single metrics record when the handler finishes
+run_counters = Counter()
+run_counters_lock = threading.Lock()
+
+def add_run_counter(name: str, value: float = 1):
+    """
+    Adds to a counter published in the run metrics. Safe to call from several threads
+    
+    Parameters:
+        name (str): The metric name, names ending in "Time" are published in milliseconds
+        value (float): The amount to add
+    """
+    with run_counters_lock:
+        run_counters[name] += value
+
+def count_api_call(model, **kwargs):
+    """
+    botocore before-call hook, counting API calls by operation. Paginated operations count one call per page
+    """
+    add_run_counter("ApiCalls")
+    add_run_counter(f"{model.name}Calls")
+
+def count_api_attempt(parsed_response, **kwargs):
+    """
+    botocore response-received hook, counting every HTTP attempt including retries, and throttled attempts
+    """
+    add_run_counter("ApiAttempts")
+    if parsed_response and parsed_response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        add_run_counter("ApiThrottles")
+
+def instrument_client(client):
+    """
+    Registers the run metrics hooks on a boto client
+    
+    Parameters:
+        client: The boto client
+    
+    Returns:
+        The same boto client
+    """
+    client.meta.events.register('before-call', count_api_call)
+    client.meta.events.register('response-received', count_api_attempt)
+    return client
+
+@contextmanager
+def timed_phase(name: str):
+    """
+    Adds the time spent in the block to the {name}Time run counter, in milliseconds
+    
+    Parameters:
+        name (str): The phase name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_run_counter(f"{name}Time", (time.perf_counter() - start) * 1000)
+
+def publish_run_metrics(handler):
+    """
+    Decorator adding the run counters to the metrics when the handler returns or fails, so they are
+    flushed as one record by metrics.log_metrics. ApiRetries is the number of attempts beyond the first of each call
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            with run_counters_lock:
+                counters = dict(run_counters)
+                run_counters.clear()
+            if 'ApiAttempts' in counters:
+                counters['ApiRetries'] = max(0, counters['ApiAttempts'] - counters.get('ApiCalls', 0))
+            for name, value in sorted(counters.items()):
+                metrics.add_metric(name=name, unit=MetricUnit.Milliseconds if name.endswith("Time") else MetricUnit.Count, value=value)
+    return wrapper
+
+ec2_clients = {}
+ec2_clients_lock = threading.Lock()
+
+# "missing" tags attachments without a Name tag, "reconcile" also rewrites Name tags which differ from the CIDR and account name
+TAG_MODE = os.environ.get('TAG_MODE', 'missing').lower()
+
+if TAG_MODE not in ("missing", "reconcile"):
+    raise RuntimeError(f"Environment Variable TAG_MODE must be 'missing' or 'reconcile', got '{TAG_MODE}'")
+
+# Where region payloads too large for the Step Functions state are offloaded: "s3://bucket/prefix" or a local directory
+PAYLOAD_LOCATION = os.environ.get('PAYLOAD_LOCATION', '').rstrip("/")
+
+s3_client = None
 
-@tracer.capture_method
 def get_ec2_client(region: str):
     """
-    Create a regional EC2 boto client
+    Return the regional EC2 boto client, creating it on first use.
+    Clients are cached at module level so warm invocations reuse their connection pool
     
     Parameters: 
         region (str): the AWS region where the client should be created
@@ -37,42 +163,295 @@ def get_ec2_client(region: str):
     Returns:
         boto3 ec2 client for the target region
     """
-    return boto3.client('ec2', region_name=region)
+    with ec2_clients_lock:
+        if region not in ec2_clients:
+            ec2_clients[region] = instrument_client(
+                boto3.client(
+                    'ec2',
+                    region_name=region,
+                    config=retry_config.merge(
+                        Config(
+                            max_pool_connections=EC2_MAX_POOL_CONNECTIONS,
+                            tcp_keepalive=EC2_TCP_KEEPALIVE
+                        )
+                    )
+                )
+            )
+        return ec2_clients[region]
+
+def get_s3_client():
+    """
+    Return the S3 boto client used for offloaded payloads, creating it on first use
+    
+    Returns:
+        boto3 s3 client
+    """
+    global s3_client
+    if s3_client is None:
+        s3_client = instrument_client(boto3.client('s3', config=retry_config))
+    return s3_client
 
 @tracer.capture_method
-def tag_tgw_attachment(attachment: dict, region: str):
+def read_payload(location: str):
+    """
+    Reads an offloaded region payload, decompressing it when the location ends in .gz
+    
+    Parameters:
+        location (str): "s3://bucket/key" or a local file path
+    
+    Returns:
+        The decoded payload
+    """
+    try:
+        if location.startswith("s3://"):
+            bucket, _, key = location[len("s3://"):].partition("/")
+            body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+        else:
+            with open(location, 'rb') as payload_file:
+                body = payload_file.read()
+    except:
+        logger.exception(f"Error reading payload {location}")
+        raise RuntimeError(f"Error reading payload {location}")
+    if location.endswith(".gz"):
+        body = gzip.decompress(body)
+    return json.loads(body)
+
+@tracer.capture_method
+def write_payload(location: str, body: str):
+    """
+    Writes a region payload, compressing it when the location ends in .gz
+    
+    Parameters:
+        location (str): "s3://bucket/key" or a local file path
+        body (str): The JSON encoded payload
+    """
+    data = body.encode('utf-8')
+    if location.endswith(".gz"):
+        data = gzip.compress(data)
+    try:
+        if location.startswith("s3://"):
+            bucket, _, key = location[len("s3://"):].partition("/")
+            get_s3_client().put_object(Bucket=bucket, Key=key, Body=data)
+        else:
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, 'wb') as payload_file:
+                payload_file.write(data)
+    except:
+        logger.exception(f"Error writing payload {location}")
+        raise RuntimeError(f"Error writing payload {location}")
+
+def encode_attachments(attachments: list):
+    """
+    Encodes attachments in the columnar layout used between the Lambdas: one list per field instead of one dictionary
+    per attachment. Fields with repeated values (transit gateway, account, the "MISSING" sentinels) are dictionary
+    encoded, storing each distinct value once and an index per attachment, and the account name is stored once
+    per account ID. Attachments with differing fields are returned unchanged
+
+    Parameters:
+        attachments (list): List of dictionaries with TGW attachment data
+
+    Returns:
+        payload (dict): {"Encoding": "columnar", "Count": n, "Columns": {field: column}}
+    """
+    fields = list(attachments[0]) if attachments else []
+    if any(list(x) != fields for x in attachments):
+        return attachments
+    columns = {}
+    for field in fields:
+        values = [x[field] for x in attachments]
+        lookup = {}
+        index = [lookup.setdefault(value, len(lookup)) for value in values]
+        if len(lookup) * 2 <= len(values):
+            columns[field] = {"Values": list(lookup), "Index": index}
+        else:
+            columns[field] = values
+    account_ids = columns.get('accountId')
+    if isinstance(account_ids, dict) and 'accountName' in columns:
+        # Every attachment owned by an account has the same account name, so names are stored per account ID
+        names = {}
+        for account_id, account_name in zip(account_ids['Index'], (x['accountName'] for x in attachments)):
+            if names.setdefault(account_id, account_name) != account_name:
+                break
+        else:
+            columns['accountName'] = {"Key": "accountId", "Values": [names[i] for i in range(len(account_ids['Values']))]}
+    return {"Encoding": "columnar", "Count": len(attachments), "Columns": columns}
+
+def decode_attachments(payload):
+    """
+    Decodes attachments from the columnar layout written by encode_attachments. Any other payload, such as the list
+    of dictionaries written by earlier versions, is returned unchanged
+
+    Parameters:
+        payload: The region payload, either columnar or a list of dictionaries with TGW attachment data
+
+    Returns:
+        attachments (list): List of dictionaries with TGW attachment data
+    """
+    if not (isinstance(payload, dict) and "columnar" == payload.get('Encoding')):
+        return payload
+    columns = payload['Columns']
+    values = {}
+    for field, column in columns.items():
+        if isinstance(column, list):
+            values[field] = column
+        elif 'Key' in column:
+            values[field] = [column['Values'][i] for i in columns[column['Key']]['Index']]
+        else:
+            # Attachments share the decoded strings, rather than holding a copy each
+            values[field] = [column['Values'][i] for i in column['Index']]
+    fields = list(columns)
+    return [dict(zip(fields, row)) for row in zip(*(values[field] for field in fields))]
+
+def load_region_attachments(map_item):
+    """
+    Returns the attachments for a Map item, reading them from the payload store when they were offloaded
+    
+    Parameters:
+        map_item: The encoded attachments or a dictionary with the PayloadLocation
+    
+    Returns:
+        payload_location (str): The location the attachments were read from, or None when they were inline
+        attachments (list): List of dictionaries with TGW attachment data
+        columnar (bool): Whether the attachments were passed in the columnar encoding
+    """
+    payload_location = None
+    if isinstance(map_item, dict) and 'PayloadLocation' in map_item:
+        payload_location = map_item['PayloadLocation']
+        map_item = read_payload(payload_location)
+    columnar = isinstance(map_item, dict) and "columnar" == map_item.get('Encoding')
+    return payload_location, decode_attachments(map_item), columnar
+
+def store_region_attachments(payload_location: str, attachments: list, name: str, columnar: bool):
+    """
+    Returns the Map item for the processed attachments, in the encoding they were received in. Offloaded input
+    is written next to the original payload under a new name, so a retried invocation still finds its input unchanged
+    
+    Parameters:
+        payload_location (str): The location the attachments were read from, or None when they were inline
+        attachments (list): List of dictionaries with TGW attachment data
+        name (str): The file name for the processed payload, without extension
+        columnar (bool): Whether to use the columnar encoding
+    
+    Returns:
+        Either the encoded attachments or a dictionary with the new PayloadLocation
     """
-    Apply Tags to TGW Attachments
+    payload = encode_attachments(attachments) if columnar else attachments
+    if not payload_location:
+        return payload
+    directory, _, file_name = payload_location.rpartition("/")
+    output_location = f"{directory}/{name}.json.gz" if file_name.endswith(".gz") else f"{directory}/{name}.json"
+    write_payload(output_location, json.dumps(payload, separators=(',', ':')))
+    return {"PayloadLocation": output_location}
+
+def get_map_region(event: dict):
+    """
+    Returns the region of the Map item. Shards of a region name it in the Region key,
+    otherwise the Map item holds a single key which is the region
     
     Parameters:
-        attachment (dict): Dictionary with TGW attachment metadata
+        event (dict): The Lambda event object
+    
+    Returns:
+        map_region (str): The AWS region to process
+    """
+    if 'Region' in event:
+        logger.info(f"Processing shard {event['Shard'] + 1} of {event['ShardCount']} for region {event['Region']}")
+        return event['Region']
+    return next(iter(event))
+
+def tag_tgw_attachment(attachment_id: str, tag_value: str, region: str):
+    """
+    Apply the Name tag to a TGW Attachment
+    
+    Parameters:
+        attachment_id (str): The TGW attachment ID
+        tag_value (str): The value of the Name tag
         region (str): The AWS region where the attachment is found
+    
+    Returns:
+        tagged (bool): False if the request failed, the error is logged so the remaining attachments can still be tagged
     """
     ec2_client = get_ec2_client(region)
-    tagValue = f"{attachment['cidr']}-{attachment['accountName']}"
 
     try:
         # Add Name tag to TGW attachment
         ec2_client.create_tags(
             Resources=[
-                attachment['attachmentId'],
+                attachment_id,
             ],
             Tags=[
                 {
                     'Key': 'Name',
-                    'Value': tagValue
+                    'Value': tag_value
                 },
             ]
         )
     except:
-        logger.exception(f"Error updating TGW attachment tag for {attachment['attachmentId']}")
-        raise RuntimeError(f"Error updating TGW attachment tag for {attachment['attachmentId']}")
+        logger.exception(f"Error updating TGW attachment tag for {attachment_id}")
+        return False
+    return True
+
+@tracer.capture_method
+def tag_region_attachments(attachments, region: str):
+    """
+    Applies missing Name tags to the attachments where we have the necessary information and there is no existing Name tag.
+    In reconcile mode existing Name tags which differ from the CIDR and account name are rewritten too, unchanged tags are
+    not written and a tag is never replaced when the CIDR or account name is unknown. Each attachment is tagged as it arrives,
+    so when the attachments are a generator tagging starts before the last one arrives. A failed attachment does not stop the rest
+
+    Parameters:
+        attachments: Iterable of dictionaries with TGW attachment data, e.g. a list or a generator, tagCreated is set in place
+        region (str): The AWS region where the attachments are found
+
+    Returns:
+        failed_ids (set): The TGW attachment IDs which could not be tagged
+    """
+    processed = 0
+    skipped = 0
+    renamed = 0
+    failed_ids = set()
+    for attachment in attachments:
+        processed += 1
+        tag_value = f"{attachment['cidr']}-{attachment['accountName']}"
+        # Logic to determine whether we should tag the attachment
+        if attachment['cidr'] in ("MISSING", "NOT_LOOKED_UP") or tag_value == attachment['nametag']:
+            # We were not able to find the CIDR from the propagated Route Table entry, or the Name tag is already correct
+            logger.debug(f"Skipping attachment {attachment['attachmentId']}")
+            attachment['tagCreated'] = False
+            skipped += 1
+        elif "MISSING" == attachment['nametag'] or ("reconcile" == TAG_MODE and "MISSING" != attachment['accountName']):
+            # Attachment has no Name tag, or in reconcile mode a stale one. An existing tag is never replaced when the
+            # owning account is unknown, e.g. a suspended, closed or external account
+            logger.debug(f"Tagging attachment {attachment['attachmentId']}")
+            if "MISSING" != attachment['nametag']:
+                renamed += 1
+            with timed_phase("Tagging"):
+                attachment['tagCreated'] = tag_tgw_attachment(attachment['attachmentId'], tag_value, region)
+            if not attachment['tagCreated']:
+                failed_ids.add(attachment['attachmentId'])
+        else:
+            logger.debug(f"Skipping attachment {attachment['attachmentId']}")
+            attachment['tagCreated'] = False
+            skipped += 1
 
+    tagged = processed - skipped - len(failed_ids)
+    logger.info(f"Tagged {tagged} ({renamed} renamed) and skipped {skipped} of {processed} attachments in {region}")
+    add_run_counter("AttachmentsProcessed", processed)
+    add_run_counter("AttachmentsSkipped", skipped)
+    add_run_counter("AttachmentsTagged", tagged)
+    add_run_counter("AttachmentsRenamed", renamed)
+    add_run_counter("AttachmentsFailed", len(failed_ids))
+    return failed_ids
+
+@metrics.log_metrics
+@publish_run_metrics
 @tracer.capture_lambda_handler
-@logger.inject_lambda_context(log_event=True)
+@logger.inject_lambda_context
 def lambda_handler(event, context):
     """
-    Applies missing Name tags to TGW attachments where we have the necessary information and there is no existing Name tag
+    Applies missing Name tags to TGW attachments where we have the necessary information and there is no existing Name tag,
+    or in reconcile mode rewrites Name tags which differ from the CIDR and account name. Attachments offloaded to the payload store are read from, and written back to, the store.
+    API calls, attachments tagged, skipped and failed and the time spent in each phase are published as one metrics record.
 
     Parameters:
         event (dict): The Lambda event object
@@ -81,20 +460,17 @@ def lambda_handler(event, context):
     Returns:
         event (dict): Updated event object, with the TGW Attachment CIDR if available
     """
-    # Get the next item in the supplied dictionary. 
-    # The Map iterator in the surrounding Step Function will supply a single region at a time to this function, 
+    # The Map iterator in the surrounding Step Function will supply a single region, or a shard of one, at a time to this function, 
     # however we do not know which at runtime
-    map_region = next(iter(event))
+    map_region = get_map_region(event)
 
     logger.info(f"Processing region {map_region}")
-    for attachment in event[map_region]:
-        # Logic to determine whether we should tag the attachment
-        if ("MISSING" == attachment['nametag']) and ("MISSING" != attachment['cidr']):
-            # Attachment has no Name tag and we were able find the CIDR from the propagated Route Table entry
-            logger.info(f"Tagging attachment {attachment['attachmentId']}")
-            tag_tgw_attachment(attachment, map_region)
-            attachment['tagCreated'] = True
-        else:
-            logger.info(f"Skipping attachment {attachment['attachmentId']}")
-            attachment['tagCreated'] = False        
+    metrics.add_metadata(key="Region", value=map_region)
+    with timed_phase("PayloadRead"):
+        payload_location, attachments, columnar = load_region_attachments(event[map_region])
+    failed_ids = tag_region_attachments(attachments, map_region)
+    if failed_ids:
+        raise RuntimeError(f"Error updating TGW attachment tags for {', '.join(sorted(failed_ids))}")
+    with timed_phase("PayloadWrite"):
+        event[map_region] = store_region_attachments(payload_location, attachments, "tagged", columnar)
     return event
\ No newline at end of file
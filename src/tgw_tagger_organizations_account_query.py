@@ -15,20 +15,283 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import boto3 # type: ignore
-import logging
-import sys
-import traceback
 import os
 import json
+import time
+import threading
+import functools
+from collections import Counter
+from contextlib import contextmanager
+from botocore.config import Config # type: ignore
 from aws_lambda_powertools import Tracer # type: ignore
 from aws_lambda_powertools import Logger # type: ignore
+from aws_lambda_powertools import Metrics # type: ignore
+from aws_lambda_powertools.metrics import MetricUnit # type: ignore
 
-sts_client = boto3.client('sts')
 tracer = Tracer(service="tgw-tagger-organizations-account-query")
 logger = Logger(service="tgw-tagger-organizations-account-query")
+metrics = Metrics(namespace="TGWAttachmentTagger", service="tgw-tagger-organizations-account-query")
+
+# Adaptive retries give the STS, Organizations and S3 clients a token bucket each, which slows requests down
+# when the API throttles, and retry throttled calls within a bounded retry budget
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '10'))
+
+retry_config = Config(
+    retries={
+        'mode': AWS_RETRY_MODE,
+        'total_max_attempts': AWS_MAX_ATTEMPTS
+    }
+)
+
+# Error codes counted as throttling in the run metrics
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'EC2ThrottledException'
+}
+
+# Counters for the current invocation, published as a single metrics record when the handler finishes
+run_counters = Counter()
+run_counters_lock = threading.Lock()
+
+def add_run_counter(name: str, value: float = 1):
+    """
+    Adds to a counter published in the run metrics. Safe to call from several threads
+    
+    Parameters:
+        name (str): The metric name, names ending in "Time" are published in milliseconds
+        value (float): The amount to add
+    """
+    with run_counters_lock:
+        run_counters[name] += value
+
+def count_api_call(model, **kwargs):
+    """
+    botocore before-call hook, counting API calls by operation. Paginated operations count one call per page
+    """
+    add_run_counter("ApiCalls")
+    add_run_counter(f"{model.name}Calls")
+
+def count_api_attempt(parsed_response, **kwargs):
+    """
+    botocore response-received hook, counting every HTTP attempt including retries, and throttled attempts
+    """
+    add_run_counter("ApiAttempts")
+    if parsed_response and parsed_response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        add_run_counter("ApiThrottles")
+
+def instrument_client(client):
+    """
+    Registers the run metrics hooks on a boto client
+    
+    Parameters:
+        client: The boto client
+    
+    Returns:
+        The same boto client
+    """
+    client.meta.events.register('before-call', count_api_call)
+    client.meta.events.register('response-received', count_api_attempt)
+    return client
+
+@contextmanager
+def timed_phase(name: str):
+    """
+    Adds the time spent in the block to the {name}Time run counter, in milliseconds
+    
+    Parameters:
+        name (str): The phase name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_run_counter(f"{name}Time", (time.perf_counter() - start) * 1000)
+
+def publish_run_metrics(handler):
+    """
+    Decorator adding the run counters to the metrics when the handler returns or fails, so they are
+    flushed as one record by metrics.log_metrics. ApiRetries is the number of attempts beyond the first of each call
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            with run_counters_lock:
+                counters = dict(run_counters)
+                run_counters.clear()
+            if 'ApiAttempts' in counters:
+                counters['ApiRetries'] = max(0, counters['ApiAttempts'] - counters.get('ApiCalls', 0))
+            for name, value in sorted(counters.items()):
+                metrics.add_metric(name=name, unit=MetricUnit.Milliseconds if name.endswith("Time") else MetricUnit.Count, value=value)
+    return wrapper
 
 ORGANIZATIONS_ROLE = os.environ.get('ORGANIZATIONS_ROLE_ARN')
 
+# Where account snapshots are cached: "s3://bucket/prefix" or a local directory. Caching is disabled when empty
+ACCOUNT_CACHE_LOCATION = os.environ.get('ACCOUNT_CACHE_LOCATION', '')
+# How long a cached snapshot is used before Organizations is queried again. Caching is disabled when 0
+ACCOUNT_CACHE_TTL_SECONDS = int(os.environ.get('ACCOUNT_CACHE_TTL_SECONDS', '0'))
+
+# Clients are created on first use rather than at import, so the init phase of a cold start does not pay for
+# clients a run may never need, such as STS when the account cache is fresh
+sts_client = None
+s3_client = None
+
+def get_sts_client():
+    """
+    Return the STS boto client, creating it on first use
+    
+    Returns:
+        boto3 sts client
+    """
+    global sts_client
+    if sts_client is None:
+        sts_client = instrument_client(boto3.client('sts', config=retry_config))
+    return sts_client
+
+def get_s3_client():
+    """
+    Return the S3 boto client used for the account cache, creating it on first use
+    
+    Returns:
+        boto3 s3 client
+    """
+    global s3_client
+    if s3_client is None:
+        s3_client = instrument_client(boto3.client('s3', config=retry_config))
+    return s3_client
+
+class S3AccountCache:
+    """
+    Stores account snapshots as objects in an S3 bucket
+    """
+    def __init__(self, bucket: str, prefix: str):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.client = get_s3_client()
+
+    def _object_key(self, key: str):
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def load(self, key: str):
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self._object_key(key))
+        except self.client.exceptions.NoSuchKey:
+            return None
+        return response['Body'].read().decode('utf-8')
+
+    def save(self, key: str, body: str):
+        self.client.put_object(Bucket=self.bucket, Key=self._object_key(key), Body=body.encode('utf-8'), ContentType='application/json')
+
+class LocalFileAccountCache:
+    """
+    Stores account snapshots as files in a local directory, for testing outside of AWS
+    """
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def load(self, key: str):
+        try:
+            with open(os.path.join(self.directory, key), encoding='utf-8') as cache_file:
+                return cache_file.read()
+        except FileNotFoundError:
+            return None
+
+    def save(self, key: str, body: str):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, key), 'w', encoding='utf-8') as cache_file:
+            cache_file.write(body)
+
+def get_account_cache(location: str):
+    """
+    Returns the account cache backend for the configured location
+    
+    Parameters:
+        location (str): "s3://bucket/prefix", a local directory or an empty string
+    
+    Returns:
+        The cache backend, or None when caching is disabled
+    """
+    if not location or ACCOUNT_CACHE_TTL_SECONDS <= 0:
+        return None
+    if location.startswith("s3://"):
+        bucket, _, prefix = location[len("s3://"):].partition("/")
+        return S3AccountCache(bucket, prefix)
+    return LocalFileAccountCache(location)
+
+def get_organization_key(role_arn: str):
+    """
+    Returns the key identifying the Organization, the management account ID from the Organizations role ARN.
+    The key is known without calling Organizations so a cached snapshot can be found before assuming the role
+    
+    Parameters:
+        role_arn (str): the ARN of the role assumed in the Organizations management account
+    
+    Returns:
+        The management account ID
+    """
+    return role_arn.split(":")[4]
+
+@tracer.capture_method
+def read_cached_account_index(account_cache, organization_key: str, ttl_seconds: int):
+    """
+    Returns the cached account index for the Organization if it is younger than the TTL
+    
+    Parameters:
+        account_cache: The cache backend
+        organization_key (str): The key identifying the Organization
+        ttl_seconds (int): The maximum age of the snapshot in seconds
+    
+    Returns:
+        account_index (dict): Dictionary of account IDs and their Name, or None on a miss
+    """
+    try:
+        body = account_cache.load(f"accounts-{organization_key}.json")
+        if body is None:
+            logger.info(f"No cached account snapshot for organization {organization_key}")
+            return None
+        snapshot = json.loads(body)
+        age = time.time() - snapshot['CreatedAt']
+        account_index = snapshot['AccountIndex']
+    except:
+        # The cache is an optimisation only, fall back to querying Organizations, which rewrites the snapshot
+        logger.exception("Error reading the account cache")
+        return None
+    if age > ttl_seconds:
+        logger.info(f"Cached account snapshot for organization {organization_key} expired {int(age - ttl_seconds)}s ago")
+        return None
+    logger.info(f"Using cached account snapshot for organization {organization_key} created {int(age)}s ago")
+    return account_index
+
+@tracer.capture_method
+def write_cached_account_index(account_cache, organization_key: str, account_index: dict):
+    """
+    Saves a snapshot of the account index for the Organization
+    
+    Parameters:
+        account_cache: The cache backend
+        organization_key (str): The key identifying the Organization
+        account_index (dict): Dictionary of account IDs and their Name
+    """
+    snapshot = {
+        "OrganizationKey": organization_key,
+        "CreatedAt": time.time(),
+        "AccountIndex": account_index
+    }
+    try:
+        account_cache.save(f"accounts-{organization_key}.json", json.dumps(snapshot, separators=(',', ':')))
+    except:
+        logger.exception("Error writing the account cache")
+
 @tracer.capture_method
 def assume_role(role_arn: str, boto_client):
     """
@@ -56,58 +319,102 @@ def assume_role(role_arn: str, boto_client):
         aws_session_token=assumed_role['Credentials']['SessionToken'])
 
 @tracer.capture_method
-def get_account_details_from_organization(organizations_client):
+def iter_active_accounts(organizations_client):
     """
-    Query the Organizations API to build a list of Account Ids and Names.
+    Query the Organizations API, yielding the Id and Name of each ACTIVE account as each page of results arrives.
     
     Parameters:
         organizations_client: the boto client object to use for the Organizations API calls
     
-    Returns:
-        result_object (list): List of accounts/Names in the Organization with status of ACTIVE    
+    Yields:
+        account (dict): Id and Name of an account in the Organization with status of ACTIVE
     """
-    result_object = []
     try:
         paginator = organizations_client.get_paginator('list_accounts')
-        iterator  = paginator.paginate()
-        for page in iterator:
-            for account in page['Accounts']:
-                if "ACTIVE" == account['Status']:
-                    logger.debug(f"Account ID {account['Id']} has status: {account['Status']}")
-                    result_object.append(
-                        {
-                            "id": account['Id'], 
-                            "name": account['Name']
-                        }
-                    )
-                else:
-                    logger.debug(f"Account ID {account['Id']} has status: {account['Status']}")
+        iterator  = iter(paginator.paginate())
     except:
         logger.exception("Error calling list_accounts for the organization")
         raise RuntimeError(f"Error calling list_accounts for the organization")
-    return result_object
+    while True:
+        # Only the API calls are guarded, the consumer of the generator handles its own errors
+        try:
+            page = next(iterator, None)
+        except:
+            logger.exception("Error calling list_accounts for the organization")
+            raise RuntimeError(f"Error calling list_accounts for the organization")
+        if page is None:
+            return
+        for account in page['Accounts']:
+            logger.debug(f"Account ID {account['Id']} has status: {account['Status']}")
+            if "ACTIVE" == account['Status']:
+                yield {
+                    "id": account['Id'], 
+                    "name": account['Name']
+                }
 
+@tracer.capture_method
+def query_account_index(force_refresh: bool):
+    """
+    Returns the index of active account IDs and Names in the Organization, from the account cache when a
+    snapshot younger than ACCOUNT_CACHE_TTL_SECONDS is available, otherwise from the Organizations API
+    
+    Parameters:
+        force_refresh (bool): Ignore the cached snapshot and query Organizations
+    
+    Returns:
+        account_index (dict): Dictionary of account IDs and their Name
+    """
+    account_cache = get_account_cache(ACCOUNT_CACHE_LOCATION)
+    organization_key = get_organization_key(ORGANIZATIONS_ROLE)
+
+    if account_cache and not force_refresh:
+        with timed_phase("AccountCacheRead"):
+            account_index = read_cached_account_index(account_cache, organization_key, ACCOUNT_CACHE_TTL_SECONDS)
+        if account_index is not None:
+            add_run_counter("AccountCacheHits")
+            add_run_counter("Accounts", len(account_index))
+            return account_index
+        add_run_counter("AccountCacheMisses")
+
+    boto3_session_object = assume_role(ORGANIZATIONS_ROLE, get_sts_client())
+
+    organizations_client = instrument_client(boto3_session_object.client('organizations', config=retry_config))
+
+    # The index is built as each page arrives, without an intermediate list of accounts
+    with timed_phase("OrganizationsQuery"):
+        account_index = {account['id']: account['name'] for account in iter_active_accounts(organizations_client)}
+
+    logger.info(f"Found {len(account_index)} active accounts in the organization")
+    add_run_counter("Accounts", len(account_index))
+    if account_cache:
+        with timed_phase("AccountCacheWrite"):
+            write_cached_account_index(account_cache, organization_key, account_index)
+    return account_index
+
+@metrics.log_metrics
+@publish_run_metrics
 @tracer.capture_lambda_handler
-@logger.inject_lambda_context(log_event=True)
+@logger.inject_lambda_context
 def lambda_handler(event, context):
     """
-    Queries the AWS Organizations API to determine menmber account IDs and Names, before returning a list of dictionaries with account information.
+    Queries the AWS Organizations API to determine menmber account IDs and Names, before returning a dictionary of account IDs and their Name.
+    The indexed form lets later stages resolve account names with a single lookup per attachment.
+    When an account cache is configured, a snapshot younger than ACCOUNT_CACHE_TTL_SECONDS is returned without calling
+    Organizations. Set "ForceAccountCacheRefresh": true in the event to ignore the cached snapshot.
+    "FullRun" in the event is passed on to the attachment query, as this function's output replaces the execution input.
+    API calls, cache hits and misses and the time spent in each phase are published as one metrics record.
 
     Parameters:
         event (dict): The Lambda event object
         context (dict): The Lambda context object   
     
     Returns:
-        response_data (dict): Dictionary containing a list of the accounts/names to process to the Step Function
+        response_data (dict): Dictionary containing an index of the account IDs/names to process to the Step Function
     """
-    boto3_session_object = assume_role(ORGANIZATIONS_ROLE, sts_client)
-
-    organizations_client = boto3_session_object.client('organizations')
-
-    account_list = get_account_details_from_organization(organizations_client)
-
-    logger.info(f"{account_list}")
+    force_refresh = isinstance(event, dict) and bool(event.get('ForceAccountCacheRefresh'))
 
     response_data = {}
-    response_data['AccountDetails'] = account_list
+    response_data['AccountIndex'] = query_account_index(force_refresh)
+    if isinstance(event, dict) and 'FullRun' in event:
+        response_data['FullRun'] = event['FullRun']
     return(response_data)
\ No newline at end of file
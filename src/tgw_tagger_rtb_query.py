@@ -15,21 +15,219 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import boto3 # type: ignore
-import logging
-import sys
-import traceback
 import os
 import json
+import ipaddress
+import gzip
+import threading
+import time
+import functools
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from botocore.config import Config # type: ignore
 from aws_lambda_powertools import Tracer # type: ignore
 from aws_lambda_powertools import Logger # type: ignore
+from aws_lambda_powertools import Metrics # type: ignore
+from aws_lambda_powertools.metrics import MetricUnit # type: ignore
 
 tracer = Tracer(service="tgw_tagger_rtb_query")
 logger = Logger(service="tgw_tagger_rtb_query")
+metrics = Metrics(namespace="TGWAttachmentTagger", service="tgw_tagger_rtb_query")
+
+EC2_MAX_POOL_CONNECTIONS = int(os.environ.get('EC2_MAX_POOL_CONNECTIONS', '10'))
+EC2_TCP_KEEPALIVE = os.environ.get('EC2_TCP_KEEPALIVE', 'true').lower() == 'true'
+
+# Adaptive retries give every client (one per region) a token bucket which slows requests down
+# when the API throttles, and retry throttled calls within a bounded retry budget
+AWS_RETRY_MODE = os.environ.get('AWS_RETRY_MODE', 'adaptive')
+AWS_MAX_ATTEMPTS = int(os.environ.get('AWS_MAX_ATTEMPTS', '10'))
+
+retry_config = Config(
+    retries={
+        'mode': AWS_RETRY_MODE,
+        'total_max_attempts': AWS_MAX_ATTEMPTS
+    }
+)
+
+# Error codes counted as throttling in the run metrics
+THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottledException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded',
+    'RequestThrottled',
+    'SlowDown',
+    'EC2ThrottledException'
+}
+
+# Counters for the current invocation, published as a single metrics record when the handler finishes
+run_counters = Counter()
+run_counters_lock = threading.Lock()
+
+def add_run_counter(name: str, value: float = 1):
+    """
+    Adds to a counter published in the run metrics. Safe to call from several threads
+    
+    Parameters:
+        name (str): The metric name, names ending in "Time" are published in milliseconds
+        value (float): The amount to add
+    """
+    with run_counters_lock:
+        run_counters[name] += value
+
+def count_api_call(model, **kwargs):
+    """
+    botocore before-call hook, counting API calls by operation. Paginated operations count one call per page
+    """
+    add_run_counter("ApiCalls")
+    add_run_counter(f"{model.name}Calls")
+
+def count_api_attempt(parsed_response, **kwargs):
+    """
+    botocore response-received hook, counting every HTTP attempt including retries, and throttled attempts
+    """
+    add_run_counter("ApiAttempts")
+    if parsed_response and parsed_response.get('Error', {}).get('Code') in THROTTLING_ERROR_CODES:
+        add_run_counter("ApiThrottles")
+
+def instrument_client(client):
+    """
+    Registers the run metrics hooks on a boto client
+    
+    Parameters:
+        client: The boto client
+    
+    Returns:
+        The same boto client
+    """
+    client.meta.events.register('before-call', count_api_call)
+    client.meta.events.register('response-received', count_api_attempt)
+    return client
+
+@contextmanager
+def timed_phase(name: str):
+    """
+    Adds the time spent in the block to the {name}Time run counter, in milliseconds
+    
+    Parameters:
+        name (str): The phase name
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_run_counter(f"{name}Time", (time.perf_counter() - start) * 1000)
+
+def publish_run_metrics(handler):
+    """
+    Decorator adding the run counters to the metrics when the handler returns or fails, so they are
+    flushed as one record by metrics.log_metrics. ApiRetries is the number of attempts beyond the first of each call
+    """
+    @functools.wraps(handler)
+    def wrapper(event, context):
+        try:
+            return handler(event, context)
+        finally:
+            with run_counters_lock:
+                counters = dict(run_counters)
+                run_counters.clear()
+            if 'ApiAttempts' in counters:
+                counters['ApiRetries'] = max(0, counters['ApiAttempts'] - counters.get('ApiCalls', 0))
+            for name, value in sorted(counters.items()):
+                metrics.add_metric(name=name, unit=MetricUnit.Milliseconds if name.endswith("Time") else MetricUnit.Count, value=value)
+    return wrapper
+
+ec2_clients = {}
+ec2_clients_lock = threading.Lock()
+
+# "index" reads every route table once and resolves attachments from an in-memory index,
+# "search" issues one filtered search per attachment per route table
+RTB_QUERY_MODE = os.environ.get('RTB_QUERY_MODE', 'index')
+
+if RTB_QUERY_MODE not in ("index", "search"):
+    raise RuntimeError(f"Environment Variable RTB_QUERY_MODE must be 'index' or 'search', got '{RTB_QUERY_MODE}'")
+
+# Most routes a single search_transit_gateway_routes call returns, larger route tables are read in prefix partitions
+ROUTE_SEARCH_MAX_RESULTS = 1000
+# Most prefixes passed in one route-search.exact-match filter
+ROUTE_SEARCH_FILTER_VALUES = 100
+
+# Route table listings and attachment CIDRs are cached in the container for this long, so a retried or repeated
+# invocation for the same region does not read the route tables again. 0 disables the cache
+RTB_CACHE_TTL_SECONDS = int(os.environ.get('RTB_CACHE_TTL_SECONDS', '300'))
+# Most route tables and attachment CIDRs held in the cache, the least recently used regions are evicted first
+RTB_CACHE_MAX_ITEMS = int(os.environ.get('RTB_CACHE_MAX_ITEMS', '200000'))
+
+# "missing" tags attachments without a Name tag, "reconcile" also rewrites Name tags which differ from the CIDR and account name
+TAG_MODE = os.environ.get('TAG_MODE', 'missing').lower()
+
+if TAG_MODE not in ("missing", "reconcile"):
+    raise RuntimeError(f"Environment Variable TAG_MODE must be 'missing' or 'reconcile', got '{TAG_MODE}'")
+
+# Where region payloads too large for the Step Functions state are offloaded: "s3://bucket/prefix" or a local directory
+PAYLOAD_LOCATION = os.environ.get('PAYLOAD_LOCATION', '').rstrip("/")
+
+s3_client = None
+
+class RouteCache:
+    """
+    Caches route table listings and attachment CIDRs per region in memory, across warm invocations of the container.
+    Entries expire after ttl_seconds, and the least recently used entries are evicted while more than max_items
+    route tables and attachments are cached. Hits, misses and evictions are added to the run metrics
+    """
+    def __init__(self, ttl_seconds: int, max_items: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_items = max_items
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def _remove(self, key):
+        _, size, _ = self.entries.pop(key)
+        self.size -= size
+
+    def get(self, key):
+        """
+        Returns the cached value, or None when it is not cached or has expired
+        """
+        if self.ttl_seconds <= 0:
+            return None
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.monotonic():
+                self._remove(key)
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+        add_run_counter("RouteCacheHits" if entry is not None else "RouteCacheMisses")
+        return entry[2] if entry is not None else None
+
+    def put(self, key, value, size: int = 1):
+        """
+        Caches a value counting as size items, evicting the least recently used entries to stay within max_items
+        """
+        if self.ttl_seconds <= 0 or size > self.max_items:
+            return
+        evicted = 0
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = (time.monotonic() + self.ttl_seconds, size, value)
+            self.size += size
+            while self.size > self.max_items:
+                self._remove(next(iter(self.entries)))
+                evicted += 1
+        if evicted:
+            add_run_counter("RouteCacheEvictions", evicted)
+
+route_cache = RouteCache(RTB_CACHE_TTL_SECONDS, RTB_CACHE_MAX_ITEMS)
 
-@tracer.capture_method
 def get_ec2_client(region: str):
     """
-    Create a regional EC2 boto client
+    Return the regional EC2 boto client, creating it on first use.
+    Clients are cached at module level so warm invocations reuse their connection pool
     
     Parameters: 
         region (str): the AWS region where the client should be created
@@ -37,21 +235,214 @@ def get_ec2_client(region: str):
     Returns:
         boto3 ec2 client for the target region
     """
-    return boto3.client('ec2', region_name=region)
+    with ec2_clients_lock:
+        if region not in ec2_clients:
+            ec2_clients[region] = instrument_client(
+                boto3.client(
+                    'ec2',
+                    region_name=region,
+                    config=retry_config.merge(
+                        Config(
+                            max_pool_connections=EC2_MAX_POOL_CONNECTIONS,
+                            tcp_keepalive=EC2_TCP_KEEPALIVE
+                        )
+                    )
+                )
+            )
+        return ec2_clients[region]
+
+def get_s3_client():
+    """
+    Return the S3 boto client used for offloaded payloads, creating it on first use
+    
+    Returns:
+        boto3 s3 client
+    """
+    global s3_client
+    if s3_client is None:
+        s3_client = instrument_client(boto3.client('s3', config=retry_config))
+    return s3_client
 
 @tracer.capture_method
-def list_tgw_route_tables(region: str):
+def read_payload(location: str):
     """
-    Returns the TGW route tables for the supplied region
+    Reads an offloaded region payload, decompressing it when the location ends in .gz
+    
+    Parameters:
+        location (str): "s3://bucket/key" or a local file path
+    
+    Returns:
+        The decoded payload
+    """
+    try:
+        if location.startswith("s3://"):
+            bucket, _, key = location[len("s3://"):].partition("/")
+            body = get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read()
+        else:
+            with open(location, 'rb') as payload_file:
+                body = payload_file.read()
+    except:
+        logger.exception(f"Error reading payload {location}")
+        raise RuntimeError(f"Error reading payload {location}")
+    if location.endswith(".gz"):
+        body = gzip.decompress(body)
+    return json.loads(body)
 
+@tracer.capture_method
+def write_payload(location: str, body: str):
+    """
+    Writes a region payload, compressing it when the location ends in .gz
+    
     Parameters:
-        region (str): The AWS region to process
+        location (str): "s3://bucket/key" or a local file path
+        body (str): The JSON encoded payload
+    """
+    data = body.encode('utf-8')
+    if location.endswith(".gz"):
+        data = gzip.compress(data)
+    try:
+        if location.startswith("s3://"):
+            bucket, _, key = location[len("s3://"):].partition("/")
+            get_s3_client().put_object(Bucket=bucket, Key=key, Body=data)
+        else:
+            os.makedirs(os.path.dirname(location), exist_ok=True)
+            with open(location, 'wb') as payload_file:
+                payload_file.write(data)
+    except:
+        logger.exception(f"Error writing payload {location}")
+        raise RuntimeError(f"Error writing payload {location}")
+
+def encode_attachments(attachments: list):
+    """
+    Encodes attachments in the columnar layout used between the Lambdas: one list per field instead of one dictionary
+    per attachment. Fields with repeated values (transit gateway, account, the "MISSING" sentinels) are dictionary
+    encoded, storing each distinct value once and an index per attachment, and the account name is stored once
+    per account ID. Attachments with differing fields are returned unchanged
+
+    Parameters:
+        attachments (list): List of dictionaries with TGW attachment data
 
     Returns:
-        result_object (list): List of TGW route tables (dict inc TGW and RTB IDs)
+        payload (dict): {"Encoding": "columnar", "Count": n, "Columns": {field: column}}
+    """
+    fields = list(attachments[0]) if attachments else []
+    if any(list(x) != fields for x in attachments):
+        return attachments
+    columns = {}
+    for field in fields:
+        values = [x[field] for x in attachments]
+        lookup = {}
+        index = [lookup.setdefault(value, len(lookup)) for value in values]
+        if len(lookup) * 2 <= len(values):
+            columns[field] = {"Values": list(lookup), "Index": index}
+        else:
+            columns[field] = values
+    account_ids = columns.get('accountId')
+    if isinstance(account_ids, dict) and 'accountName' in columns:
+        # Every attachment owned by an account has the same account name, so names are stored per account ID
+        names = {}
+        for account_id, account_name in zip(account_ids['Index'], (x['accountName'] for x in attachments)):
+            if names.setdefault(account_id, account_name) != account_name:
+                break
+        else:
+            columns['accountName'] = {"Key": "accountId", "Values": [names[i] for i in range(len(account_ids['Values']))]}
+    return {"Encoding": "columnar", "Count": len(attachments), "Columns": columns}
+
+def decode_attachments(payload):
+    """
+    Decodes attachments from the columnar layout written by encode_attachments. Any other payload, such as the list
+    of dictionaries written by earlier versions, is returned unchanged
+
+    Parameters:
+        payload: The region payload, either columnar or a list of dictionaries with TGW attachment data
+
+    Returns:
+        attachments (list): List of dictionaries with TGW attachment data
+    """
+    if not (isinstance(payload, dict) and "columnar" == payload.get('Encoding')):
+        return payload
+    columns = payload['Columns']
+    values = {}
+    for field, column in columns.items():
+        if isinstance(column, list):
+            values[field] = column
+        elif 'Key' in column:
+            values[field] = [column['Values'][i] for i in columns[column['Key']]['Index']]
+        else:
+            # Attachments share the decoded strings, rather than holding a copy each
+            values[field] = [column['Values'][i] for i in column['Index']]
+    fields = list(columns)
+    return [dict(zip(fields, row)) for row in zip(*(values[field] for field in fields))]
+
+def load_region_attachments(map_item):
+    """
+    Returns the attachments for a Map item, reading them from the payload store when they were offloaded
+    
+    Parameters:
+        map_item: The encoded attachments or a dictionary with the PayloadLocation
+    
+    Returns:
+        payload_location (str): The location the attachments were read from, or None when they were inline
+        attachments (list): List of dictionaries with TGW attachment data
+        columnar (bool): Whether the attachments were passed in the columnar encoding
+    """
+    payload_location = None
+    if isinstance(map_item, dict) and 'PayloadLocation' in map_item:
+        payload_location = map_item['PayloadLocation']
+        map_item = read_payload(payload_location)
+    columnar = isinstance(map_item, dict) and "columnar" == map_item.get('Encoding')
+    return payload_location, decode_attachments(map_item), columnar
+
+def store_region_attachments(payload_location: str, attachments: list, name: str, columnar: bool):
+    """
+    Returns the Map item for the processed attachments, in the encoding they were received in. Offloaded input
+    is written next to the original payload under a new name, so a retried invocation still finds its input unchanged
+    
+    Parameters:
+        payload_location (str): The location the attachments were read from, or None when they were inline
+        attachments (list): List of dictionaries with TGW attachment data
+        name (str): The file name for the processed payload, without extension
+        columnar (bool): Whether to use the columnar encoding
+    
+    Returns:
+        Either the encoded attachments or a dictionary with the new PayloadLocation
+    """
+    payload = encode_attachments(attachments) if columnar else attachments
+    if not payload_location:
+        return payload
+    directory, _, file_name = payload_location.rpartition("/")
+    output_location = f"{directory}/{name}.json.gz" if file_name.endswith(".gz") else f"{directory}/{name}.json"
+    write_payload(output_location, json.dumps(payload, separators=(',', ':')))
+    return {"PayloadLocation": output_location}
+
+def get_map_region(event: dict):
+    """
+    Returns the region of the Map item. Shards of a region name it in the Region key,
+    otherwise the Map item holds a single key which is the region
+    
+    Parameters:
+        event (dict): The Lambda event object
+    
+    Returns:
+        map_region (str): The AWS region to process
+    """
+    if 'Region' in event:
+        logger.info(f"Processing shard {event['Shard'] + 1} of {event['ShardCount']} for region {event['Region']}")
+        return event['Region']
+    return next(iter(event))
+
+@tracer.capture_method
+def iter_tgw_route_tables(region: str):
+    """
+    Yields the TGW route tables for the supplied region as each page of results arrives
+
+    Parameters:
+        region (str): The AWS region to process
+
+    Yields:
+        route_table (dict): TGW route table, inc TGW and RTB IDs
     """
     ec2 = get_ec2_client(region)    
-    result_object = []
     try:
         paginator = ec2.get_paginator('describe_transit_gateway_route_tables')    
         iterator  = paginator.paginate(
@@ -69,18 +460,38 @@ def list_tgw_route_tables(region: str):
         raise RuntimeError(f"Error getting TGW RTB for region {region}")    
     for page in iterator:
         for rtb in page['TransitGatewayRouteTables']:
-            result_object.append(
-                {
-                    "tgwId": rtb['TransitGatewayId'], 
-                    "rtbId": rtb['TransitGatewayRouteTableId']
-                }
-            )
-    return result_object
+            add_run_counter("RouteTables")
+            yield {
+                "tgwId": rtb['TransitGatewayId'], 
+                "rtbId": rtb['TransitGatewayRouteTableId']
+            }
+
+def list_tgw_route_tables(region: str):
+    """
+    Returns the TGW route tables for the supplied region
+
+    Parameters:
+        region (str): The AWS region to process
+
+    Returns:
+        result_object (list): List of TGW route tables (dict inc TGW and RTB IDs)
+    """
+    return list(iter_tgw_route_tables(region))
+
+def route_preference(route: dict):
+    """
+    Returns the sort key choosing the CIDR of an attachment with several routes: propagated routes before static routes,
+    then IPv4 before IPv6, the widest prefix and the lowest address, so the same CIDR is chosen whatever order the routes are read in
+
+    Parameters:
+        route (dict): A route returned by search_transit_gateway_routes, with a DestinationCidrBlock
+    """
+    network = ipaddress.ip_network(route['DestinationCidrBlock'])
+    return ("propagated" != route.get('Type'), network.version, network.prefixlen, int(network.network_address))
 
-@tracer.capture_method
 def find_tgw_attachment_cidr(attachment_id: str, route_table_list: list, region: str):
     """
-    Returns the cidr range for a TGW attachment
+    Returns the cidr range for a TGW attachment, the preferred route (see route_preference) across all route tables
 
     Parameters:
         attachment_id (str): The TGW attachment ID
@@ -92,19 +503,12 @@ def find_tgw_attachment_cidr(attachment_id: str, route_table_list: list, region:
     """
     result_object = []
     for route_table in route_table_list:
-        cidr_range = search_rtb_for_attachment(attachment_id, route_table['rtbId'], region)
-        if cidr_range:
-            result_object.append(
-                {
-                    "cidr": cidr_range
-                }
-            )
-    if len(result_object) == 1:
-        return result_object[0]['cidr']
+        result_object.extend(search_rtb_for_attachment(attachment_id, route_table['rtbId'], region))
+    if result_object:
+        return min(result_object, key=route_preference)['DestinationCidrBlock']
     else:
         return None
 
-@tracer.capture_method
 def search_rtb_for_attachment(attachment_id: str, route_table_id: str, region: str):
     """
     Searches RTB for the TGW Attachment ID
@@ -115,10 +519,9 @@ def search_rtb_for_attachment(attachment_id: str, route_table_id: str, region: s
         region (str): The AWS region to process
     
     Returns:
-        result_object: Either the CIDR block as a string or None    
+        result_object (list): The routes to the attachment which have a CIDR block, an attachment may propagate several CIDRs
     """
     ec2 = get_ec2_client(region)
-    result_object = None
     try:
         response = ec2.search_transit_gateway_routes(
             TransitGatewayRouteTableId=route_table_id,
@@ -134,17 +537,231 @@ def search_rtb_for_attachment(attachment_id: str, route_table_id: str, region: s
     except:
         logger.exception(f"Error searching TGW Route Table: {route_table_id}") 
         raise RuntimeError(f"Error searching TGW Route Table: {route_table_id}")
-    if response['Routes']:
-        # An attachment may only be associated with a single Route Table, however the API returns a list containing a single element
-        for route in response['Routes']:
-            result_object = route['DestinationCidrBlock']
-    return result_object
+    # Prefix list routes carry no CIDR block
+    return [route for route in response['Routes'] if 'DestinationCidrBlock' in route]
+
+def search_route_table(ec2, route_table_id: str, filters: list):
+    """
+    Returns one search_transit_gateway_routes response of up to ROUTE_SEARCH_MAX_RESULTS static and propagated routes
+
+    Parameters:
+        ec2: The regional EC2 client
+        route_table_id (str): The Route Table ID
+        filters (list): Filters added to the route type filter
+    """
+    try:
+        return ec2.search_transit_gateway_routes(
+            TransitGatewayRouteTableId=route_table_id,
+            Filters=[
+                {
+                    'Name': 'type',
+                    'Values': [
+                        'static',
+                        'propagated',
+                    ]
+                },
+            ] + filters,
+            MaxResults=ROUTE_SEARCH_MAX_RESULTS
+        )
+    except:
+        logger.exception(f"Error searching TGW Route Table: {route_table_id}")
+        raise RuntimeError(f"Error searching TGW Route Table: {route_table_id}")
+
+def iter_route_table_routes(route_table_id: str, region: str):
+    """
+    Yields every static and propagated route of a TGW route table. A search returns at most ROUTE_SEARCH_MAX_RESULTS routes,
+    so larger route tables are read in prefix partitions: a partition still too large for one search is split in halves
+    until each half fits. Routes to a split partition itself belong to neither half, they are read with exact match searches at the end
+
+    Parameters:
+        route_table_id (str): The Route Table ID
+        region (str): The AWS region to process
+
+    Yields:
+        route (dict): A route returned by search_transit_gateway_routes
+    """
+    ec2 = get_ec2_client(region)
+    response = search_route_table(ec2, route_table_id, [])
+    if not response.get('AdditionalRoutesAvailable'):
+        yield from response['Routes']
+        return
+    logger.info(f"TGW Route Table {route_table_id} has more routes than a single search returns, reading it in prefix partitions")
+    add_run_counter("PartitionedRouteTables")
+    partitions = [ipaddress.ip_network("::/0"), ipaddress.ip_network("0.0.0.0/0")]
+    split_partitions = []
+    while partitions:
+        partition = partitions.pop()
+        response = search_route_table(ec2, route_table_id, [{'Name': 'route-search.subnet-of-match', 'Values': [str(partition)]}])
+        if response.get('AdditionalRoutesAvailable'):
+            split_partitions.append(str(partition))
+            partitions.extend(reversed(list(partition.subnets(prefixlen_diff=1))))
+        else:
+            yield from response['Routes']
+    for i in range(0, len(split_partitions), ROUTE_SEARCH_FILTER_VALUES):
+        response = search_route_table(ec2, route_table_id, [{'Name': 'route-search.exact-match', 'Values': split_partitions[i:i + ROUTE_SEARCH_FILTER_VALUES]}])
+        yield from response['Routes']
+
+@tracer.capture_method
+def build_attachment_cidr_index(route_table_list, region: str):
+    """
+    Reads every route table in bulk, streaming its routes into an index of the preferred CIDR of each attachment
+
+    Parameters:
+        route_table_list: The route table information, a list or an iterator such as iter_tgw_route_tables
+        region (str): The AWS region to process
+
+    Returns:
+        index (dict): Maps each TGW attachment ID to the CIDR block of its preferred route
+    """
+    index = {}
+    for route_table in route_table_list:
+        for route in iter_route_table_routes(route_table['rtbId'], region):
+            if 'DestinationCidrBlock' not in route:
+                # Prefix list routes carry no CIDR block
+                continue
+            preference = route_preference(route)
+            for attachment in route.get('TransitGatewayAttachments', []):
+                current = index.get(attachment['TransitGatewayAttachmentId'])
+                if current is None or preference < current[0]:
+                    index[attachment['TransitGatewayAttachmentId']] = (preference, route['DestinationCidrBlock'])
+    return {attachment_id: cidr for attachment_id, (_, cidr) in index.items()}
+
+def get_attachment_cidr_index(region: str, refresh: bool = False):
+    """
+    Returns the attachment CIDR index of the region from the route cache, building it when it is not cached
+
+    Parameters:
+        region (str): The AWS region to process
+        refresh (bool): Build the index even when it is cached
+
+    Returns:
+        index (dict): The index returned by build_attachment_cidr_index
+        cached (bool): Whether the index was taken from the route cache
+    """
+    index = None if refresh else route_cache.get(("index", region))
+    cached = index is not None
+    if index is None:
+        # The route tables are indexed as they are listed, without holding the listing
+        with timed_phase("IndexBuild"):
+            index = build_attachment_cidr_index(iter_tgw_route_tables(region), region)
+        route_cache.put(("index", region), index, len(index))
+    return index, cached
+
+def get_tgw_route_tables(region: str):
+    """
+    Returns the route tables of the region from the route cache, listing them when they are not cached
+
+    Parameters:
+        region (str): The AWS region to process
+
+    Returns:
+        route_tables (list): The list returned by list_tgw_route_tables
+    """
+    route_tables = route_cache.get(("route-tables", region))
+    if route_tables is None:
+        with timed_phase("RouteTableList"):
+            route_tables = list_tgw_route_tables(region)
+        route_cache.put(("route-tables", region), route_tables, len(route_tables))
+    return route_tables
+
+def find_tgw_attachment_cidr_in_index(attachment_id: str, index: dict):
+    """
+    Returns the cidr range for a TGW attachment using the route table index
+
+    Parameters:
+        attachment_id (str): The TGW attachment ID
+        index (dict): The index returned by build_attachment_cidr_index
+
+    Returns:
+        Either the TGW cidr as a string or None
+    """
+    return index.get(attachment_id)
+
+@tracer.capture_method
+def iter_resolved_attachments(attachments, region: str):
+    """
+    Sets the cidr of each attachment without a Name tag (of every attachment in reconcile mode), from the TGW route
+    tables in the region, and yields each attachment as soon as it is resolved. The tagger never uses the CIDR of the
+    other attachments, so their cidr is set to "NOT_LOOKED_UP". Route tables are read when the first attachment needing
+    a lookup arrives, so they are not read at all when no attachment needs one. The route tables, index and
+    CIDRs found are taken from the route cache when a recent invocation read them.
+
+    Parameters:
+        attachments: Iterable of dictionaries with TGW attachment data, e.g. a list or a generator, updated in place
+        region (str): The AWS region to process
+
+    Yields:
+        attachment (dict): TGW attachment data, with the cidr set
+    """
+    processed = 0
+    eligible = 0
+    cidrs_found = 0
+    index = None
+    index_cached = False
+    route_tables = None
+    for a in attachments:
+        processed += 1
+        if "MISSING" != a['nametag'] and "reconcile" != TAG_MODE:
+            a['cidr'] = "NOT_LOOKED_UP"
+            yield a
+            continue
+        eligible += 1
+        logger.debug(f"Processing attachment {a['attachmentId']}")
+        if "index" == RTB_QUERY_MODE:
+            if index is None:
+                index, index_cached = get_attachment_cidr_index(region)
+            with timed_phase("CidrLookup"):
+                cidr = find_tgw_attachment_cidr_in_index(a['attachmentId'], index)
+            if not cidr and index_cached:
+                # The cached index may predate the attachment's routes, as in search mode a missing CIDR is looked up
+                # again: the index is rebuilt, at most once per invocation, and replaces the cached one
+                index, index_cached = get_attachment_cidr_index(region, refresh=True)
+                with timed_phase("CidrLookup"):
+                    cidr = find_tgw_attachment_cidr_in_index(a['attachmentId'], index)
+        else:
+            cidr = route_cache.get(("cidr", region, a['attachmentId']))
+            if cidr is None:
+                if route_tables is None:
+                    route_tables = get_tgw_route_tables(region)
+                with timed_phase("CidrLookup"):
+                    cidr = find_tgw_attachment_cidr(a['attachmentId'], route_tables, region)
+                if cidr:
+                    # Attachments without a CIDR are searched again, their routes may not have propagated yet
+                    route_cache.put(("cidr", region, a['attachmentId']), cidr)
+        if cidr:
+            a['cidr'] = cidr
+            cidrs_found += 1
+        else:
+            a['cidr'] = "MISSING"
+        yield a
+    logger.info(f"Found the CIDR of {cidrs_found} of {eligible} attachments needing a lookup, out of {processed} attachments in {region}")
+    add_run_counter("AttachmentsProcessed", processed)
+    add_run_counter("AttachmentsSkipped", processed - eligible)
+    add_run_counter("CidrsFound", cidrs_found)
+    add_run_counter("CidrsMissing", eligible - cidrs_found)
+
+def resolve_attachment_cidrs(attachments: list, region: str):
+    """
+    Sets the cidr of each attachment without a Name tag, from the TGW route tables in the region.
+    The tagger never uses the CIDR of the other attachments, so their cidr is set to "NOT_LOOKED_UP"
+    and route tables are not read at all when no attachment needs a lookup.
+
+    Parameters:
+        attachments (list): List of dictionaries with TGW attachment data, updated in place
+        region (str): The AWS region to process
+    """
+    for _ in iter_resolved_attachments(attachments, region):
+        pass
 
+@metrics.log_metrics
+@publish_run_metrics
 @tracer.capture_lambda_handler
-@logger.inject_lambda_context(log_event=True)
+@logger.inject_lambda_context
 def lambda_handler(event, context):
     """
-    Queries the TGW route tables for the supplied region, to find out the CIDR range associated with the attachment
+    Queries the TGW route tables for the supplied region, to find out the CIDR range associated with the attachment.
+    Attachments offloaded to the payload store are read from, and written back to, the store.
+    API calls, route tables read, CIDRs found and the time spent in each phase are published as one metrics record.
 
     Parameters:
         event (dict): The Lambda event object
@@ -153,14 +770,12 @@ def lambda_handler(event, context):
     Returns:
         event (dict): Updated event object, with the TGW Attachment CIDR if available
     """
-    # Get the next item in the supplied dictionary. The Map iterator in the surrounding Step Function will supply a single region at a time to this function - however we do not know which at runtime
-    map_region = next(iter(event))
-    rtb = list_tgw_route_tables(map_region)
-    for a in event[map_region]:
-        logger.info(f"Processing attachment {a['attachmentId']}")
-        cidr = find_tgw_attachment_cidr(a['attachmentId'], rtb, map_region)
-        if cidr:
-            a['cidr'] = cidr
-        else:
-            a['cidr'] = "MISSING"
+    # The Map iterator in the surrounding Step Function will supply a single region, or a shard of one, at a time to this function - however we do not know which at runtime
+    map_region = get_map_region(event)
+    metrics.add_metadata(key="Region", value=map_region)
+    with timed_phase("PayloadRead"):
+        payload_location, attachments, columnar = load_region_attachments(event[map_region])
+    resolve_attachment_cidrs(attachments, map_region)
+    with timed_phase("PayloadWrite"):
+        event[map_region] = store_region_attachments(payload_location, attachments, "cidrs", columnar)
     return event
\ No newline at end of file
@@ -0,0 +1,173 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""
+Runs the whole pipeline in a single process, without Step Functions: the Organizations account query once,
+then the attachment query, RTB query and tagger for each region. Regions are processed in parallel, sharing
+the account index and regional EC2 clients, and attachments are passed between stages in memory.
+
+The Lambda modules are reused as they are, so the configuration is read from the same environment variables
+(REGION_LIST, TGW_LIST, ORGANIZATIONS_ROLE_ARN, DELTA_MODE, ...). Credentials must allow the actions granted to
+the Lambda roles in the main stack, and assuming the Organizations role.
+
+Usage:
+    ORGANIZATIONS_ROLE_ARN=arn:aws:iam::111111111111:role/tgw-attachment-tagger-organization-query-role \\
+        python src/tgw_tagger_runner.py --regions eu-west-1,us-east-1 [--output attachments.json]
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# The Lambda modules read their configuration when imported, so they are loaded once the command line has been applied
+account_query = None
+attachment_query = None
+rtb_query = None
+attachment_tagger = None
+
+def load_pipeline():
+    """
+    Imports the Lambda modules. The RTB query and tagger use the attachment query's regional EC2 clients,
+    so each region has a single client and connection pool for the whole run
+    """
+    global account_query, attachment_query, rtb_query, attachment_tagger
+    import tgw_tagger_organizations_account_query as account_query
+    import tgw_tagger_attachment_query as attachment_query
+    import tgw_tagger_rtb_query as rtb_query
+    import tgw_tagger_attachment_tagger as attachment_tagger
+    rtb_query.get_ec2_client = attachment_query.get_ec2_client
+    attachment_tagger.get_ec2_client = attachment_query.get_ec2_client
+
+def record_attachments(attachments, records: list):
+    """
+    Yields the attachments unchanged, appending each one to records
+    """
+    for attachment in attachments:
+        records.append(attachment)
+        yield attachment
+
+def process_region(account_index: dict, region: str, checkpoint_store, full_run: bool):
+    """
+    Runs the attachment query, RTB query and tagger for a single region. The stages are chained as generators,
+    so attachments are resolved and tagged while later pages of attachments are still being fetched
+
+    Parameters:
+        account_index (dict): Dictionary of account IDs and their Name
+        region (str): The AWS region to process
+        checkpoint_store: The checkpoint store in delta mode, otherwise None
+        full_run (bool): Process every attachment in delta mode
+
+    Returns:
+        attachments (list): List of dictionaries with TGW attachment data, as returned by the tagger
+        failed_ids (set): The TGW attachment IDs which could not be tagged
+    """
+    attachments = []
+    stream = attachment_query.iter_region_attachments(account_index, region, checkpoint_store, full_run)
+    stream = rtb_query.iter_resolved_attachments(stream, region)
+    failed_ids = attachment_tagger.tag_region_attachments(record_attachments(stream, attachments), region)
+    return attachments, failed_ids
+
+def collect_run_counters():
+    """
+    Returns the run counters of every stage added together, resetting them
+
+    Returns:
+        counters (dict): Counter name -> value, phase times are in milliseconds and summed across regions
+    """
+    counters = Counter()
+    for module in (account_query, attachment_query, rtb_query, attachment_tagger):
+        with module.run_counters_lock:
+            counters.update(module.run_counters)
+            module.run_counters.clear()
+    if 'ApiAttempts' in counters:
+        counters['ApiRetries'] = max(0, counters['ApiAttempts'] - counters.get('ApiCalls', 0))
+    return dict(sorted(counters.items()))
+
+def run_pipeline(force_account_cache_refresh: bool = False, full_run: bool = False):
+    """
+    Runs the pipeline for every region in REGION_LIST
+
+    Parameters:
+        force_account_cache_refresh (bool): Ignore the cached account snapshot and query Organizations
+        full_run (bool): Process every attachment in delta mode
+
+    Returns:
+        summary (dict): Attachment counts per region, failed regions and the run counters
+        results (dict): Region -> list of dictionaries with TGW attachment data, for the regions which succeeded
+    """
+    start = time.perf_counter()
+    account_index = account_query.query_account_index(force_account_cache_refresh)
+    checkpoint_store = attachment_query.get_checkpoint_store(attachment_query.CHECKPOINT_LOCATION) if attachment_query.DELTA_MODE else None
+
+    summary = {"Regions": {}, "FailedRegions": []}
+    results = {}
+    region_list = attachment_query.REGION_LIST
+    if not account_index:
+        # As in the attachment query Lambda no region is processed, every attachment would be named after a MISSING account
+        attachment_query.logger.error("The account index is empty, no region is processed")
+        summary['FailedRegions'] = list(region_list)
+        region_list = []
+    with ThreadPoolExecutor(max_workers=max(1, min(attachment_query.REGION_CONCURRENCY, len(region_list)))) as executor:
+        futures = [(region, executor.submit(process_region, account_index, region, checkpoint_store, full_run)) for region in region_list]
+
+    for region, future in futures:
+        try:
+            attachments, failed_ids = future.result()
+        except Exception:
+            attachment_query.logger.exception(f"Error processing region {region}")
+            summary['FailedRegions'].append(region)
+            continue
+        results[region] = attachments
+        summary['Regions'][region] = {
+            "Attachments": len(attachments),
+            "Tagged": sum(1 for x in attachments if x.get('tagCreated')),
+            "FailedAttachments": sorted(failed_ids)
+        }
+    summary['ElapsedSeconds'] = round(time.perf_counter() - start, 3)
+    summary['Metrics'] = collect_run_counters()
+    return summary, results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regions', help="comma separated regions to process, overrides REGION_LIST")
+    parser.add_argument('--exclude-tgws', help="comma separated Transit Gateway IDs to exclude, overrides TGW_LIST")
+    parser.add_argument('--force-account-cache-refresh', action='store_true', help="ignore the cached account snapshot")
+    parser.add_argument('--full-run', action='store_true', help="process every attachment when DELTA_MODE is enabled")
+    parser.add_argument('--output', help="write the processed attachments of each region to this JSON file")
+    args = parser.parse_args()
+
+    if args.regions:
+        os.environ['REGION_LIST'] = args.regions
+    if args.exclude_tgws is not None:
+        os.environ['TGW_LIST'] = args.exclude_tgws
+    if not os.environ.get('REGION_LIST'):
+        parser.error("REGION_LIST is not set, use --regions")
+    load_pipeline()
+
+    summary, results = run_pipeline(args.force_account_cache_refresh, args.full_run)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+    print(json.dumps(summary, indent=2))
+    if summary['FailedRegions'] or any(x['FailedAttachments'] for x in summary['Regions'].values()):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()